@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Сверка векторных критериев detecting_cheaters_batch со scipy.stats, работает без сети.
+
+_batch_ttest, _batch_bartlett, _batch_levene и _batch_mannwhitneyu повторяют stats.ttest_ind,
+stats.bartlett, stats.levene(center='median') и stats.mannwhitneyu (асимптотический, с поправкой на
+непрерывность) для всех групп сразу. На них же опираются BaselineIndex и SequentialTest, поэтому
+p-value сверяются с scipy на players_stats.csv как базе и нескольких группах подозреваемых:
+tournament_stats.csv и синтетических группах разного размера, со сдвигом и без, с большим числом связей.
+
+Скрипт завершается с кодом 1, если какое-либо p-value отличается от scipy больше чем на --rtol.
+
+Примеры:
+    python benchmarks/check_batch_stats.py
+    python benchmarks/check_batch_stats.py --rtol 1e-6
+"""
+
+import argparse
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import numpy as np                                    # noqa: E402
+import pandas as pd                                   # noqa: E402
+from scipy import stats                               # noqa: E402
+
+import corpus                                         # noqa: E402
+import detecting_cheaters_on_lichess as dc            # noqa: E402
+
+
+def suspect_groups(seed=0):
+    """Группы подозреваемых: имя -> DataFrame в формате players_stats.csv"""
+    groups = {"tournament": pd.read_csv(os.path.join(REPO_DIR, "tournament_stats.csv"), index_col=0)}
+    for n_rows, shift in ((3, 0.0), (10, 0.0), (25, 3.0), (50, 6.0), (200, -2.0)):
+        groups[f"synthetic_{n_rows}_{shift:+.0f}"] = corpus.generate_player_stats(n_rows=n_rows, seed=seed + n_rows, accuracy_shift=shift)
+    # Много связей: значения только из нескольких уровней, частично совпадающих с базой
+    rng = np.random.default_rng(seed)
+    ties = corpus.generate_player_stats(n_rows=40, seed=seed)
+    ties["Accuracy"] = rng.choice([75.0, 80.0, 85.0], size=len(ties))
+    ties["AvgLoss"] = rng.choice([40.0, 60.0], size=len(ties))
+    ties["Blunders"] = rng.choice([0, 1, 2], size=len(ties))
+    groups["ties"] = ties
+    return groups
+
+
+def metric_values(baseline, suspect, metric, transform=None):
+    """Значения метрики базы и группы (после нормализующего преобразования, если оно задано)"""
+    base = baseline[metric].to_numpy(dtype=np.float64)
+    values = suspect[metric].to_numpy(dtype=np.float64)
+    if transform is not None:
+        base, values = transform(base), transform(values)
+    return base, values
+
+
+def check(baseline_data, groups, rtol):
+    baseline = dc.PreparedBaseline(baseline_data)
+    suspects = pd.concat([df.assign(Group=name) for name, df in groups.items()], ignore_index=True)
+    codes, names = pd.factorize(suspects["Group"], sort=True)
+    n_groups = len(names)
+
+    def column(metric, transform=None):
+        values = suspects[metric].to_numpy(dtype=np.float64)
+        return transform(values) if transform is not None else values
+
+    # (название, векторный результат, функция scipy от (база, группа))
+    cases = []
+    for metric, alternative in (("Accuracy", "greater"), ("AvgLoss", "less")):
+        for equal_var in (True, False):
+            cases.append((
+                f"ttest {metric} {alternative} equal_var={equal_var}",
+                dc._batch_ttest(baseline[metric], column(metric), codes, n_groups, alternative, equal_var),
+                metric, None,
+                lambda base, values, alternative=alternative, equal_var=equal_var:
+                    stats.ttest_ind(values, base, equal_var=equal_var, alternative=alternative).pvalue
+            ))
+    cases.append((
+        "bartlett Normalized Accuracy",
+        dc._batch_bartlett(baseline["Normalized Accuracy"], column("Accuracy", np.square), codes, n_groups),
+        "Accuracy", np.square, lambda base, values: stats.bartlett(base, values).pvalue
+    ))
+    cases.append((
+        "bartlett Normalized AvgLoss",
+        dc._batch_bartlett(baseline["Normalized AvgLoss"], column("AvgLoss", np.sqrt), codes, n_groups),
+        "AvgLoss", np.sqrt, lambda base, values: stats.bartlett(base, values).pvalue
+    ))
+    cases.append((
+        "levene(center='median') Blunders",
+        dc._batch_levene(baseline["Blunders"], column("Blunders"), codes, n_groups),
+        "Blunders", None, lambda base, values: stats.levene(base, values, center="median").pvalue
+    ))
+    for metric, alternative in (("Accuracy", "greater"), ("AvgLoss", "less"), ("Blunders", "less")):
+        cases.append((
+            f"mannwhitneyu {metric} {alternative}",
+            dc._batch_mannwhitneyu(baseline[metric], column(metric), codes, n_groups, alternative),
+            metric, None,
+            lambda base, values, alternative=alternative:
+                stats.mannwhitneyu(values, base, alternative=alternative, method="asymptotic", use_continuity=True).pvalue
+        ))
+
+    failures = []
+    print(f"{'test':<45}{'groups':>8}{'max rel. error':>18}")
+    for name, actual, metric, transform, reference in cases:
+        worst = 0.0
+        for code, group in enumerate(names):
+            base, values = metric_values(baseline_data, groups[group], metric, transform)
+            expected = reference(base, values)
+            if not np.isclose(actual[code], expected, rtol=rtol, atol=1e-300, equal_nan=True):
+                failures.append(f"{name} [{group}]: {actual[code]!r} != scipy {expected!r}")
+            if expected and not np.isnan(expected):
+                worst = max(worst, abs(actual[code] - expected) / abs(expected))
+        print(f"{name:<45}{n_groups:>8}{worst:>18.2e}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сверка векторных критериев detecting_cheaters_batch со scipy.stats")
+    parser.add_argument("--baseline", default=os.path.join(REPO_DIR, "players_stats.csv"), help="CSV с базовой выборкой")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rtol", type=float, default=1e-8, help="Допустимое относительное отличие p-value от scipy")
+    args = parser.parse_args(argv)
+
+    baseline_data = pd.read_csv(args.baseline, index_col=0)
+    failures = check(baseline_data, suspect_groups(args.seed), args.rtol)
+
+    if failures:
+        print("\nРасхождения со scipy:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print("\nВсе p-value совпадают со scipy")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Генератор синтетического корпуса для бенчмарков: партии со случайными легальными ходами
+в формате экспорта Lichess и таблицы метрик в формате players_stats.csv.
+Все генераторы детерминированы при фиксированном seed.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+import chess
+import chess.pgn
+import numpy as np
+import pandas as pd
+
+
+def generate_games(n_games=200, plies=80, seed=0, players=("player", "opponent1", "opponent2", "opponent3")):
+    """
+    Генерирует партии со случайными легальными ходами.
+
+    Параметры:
+        n_games (int): Число партий
+        plies (int): Максимальная длина партии в полуходах (партия может закончиться раньше матом или патом)
+        seed (int): Зерно генератора
+        players (tuple): Ники игроков; первый играет во всех партиях, чередуя цвет
+
+    Возвращает:
+        list: Список объектов chess.pgn.Game
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    games = []
+
+    for index in range(n_games):
+        opponent = players[1 + index % (len(players) - 1)]
+        white, black = (players[0], opponent) if index % 2 == 0 else (opponent, players[0])
+        played_at = start + timedelta(minutes=37 * index)
+
+        game = chess.pgn.Game()
+        game.headers["Event"] = "Rated Blitz game"
+        game.headers["Site"] = f"https://lichess.org/{seed:02d}{index:06d}"
+        game.headers["Date"] = played_at.strftime("%Y.%m.%d")
+        game.headers["White"] = white
+        game.headers["Black"] = black
+        game.headers["UTCDate"] = played_at.strftime("%Y.%m.%d")
+        game.headers["UTCTime"] = played_at.strftime("%H:%M:%S")
+        game.headers["WhiteElo"] = str(rng.randint(1200, 2400))
+        game.headers["BlackElo"] = str(rng.randint(1200, 2400))
+        game.headers["TimeControl"] = "180+0"
+
+        board = chess.Board()
+        node = game
+        for _ in range(plies):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            board.push(move)
+            node = node.add_variation(move)
+        game.headers["Result"] = board.result(claim_draw=False) if board.is_game_over() else "*"
+        games.append(game)
+
+    return games
+
+
+def games_to_pgn(games):
+    """Склеивает партии в один PGN-текст, как в выгрузке Lichess"""
+    return "\n\n\n".join(str(game) for game in games) + "\n\n\n"
+
+
+def write_corpus(path, n_games=200, plies=80, seed=0):
+    """Записывает синтетический корпус в PGN-файл и возвращает путь к нему"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(games_to_pgn(generate_games(n_games=n_games, plies=plies, seed=seed)))
+    return path
+
+
+def generate_scores(n_games=1000, plies=80, seed=0):
+    """Случайные оценки позиций в формате analyze_games_with_engine (пешки, ±10)"""
+    rng = np.random.default_rng(seed)
+    all_games_scores = []
+    for _ in range(n_games):
+        walk = np.clip(np.round(np.cumsum(rng.normal(0, 0.6, plies)), 2), -10, 10)
+        all_games_scores.append([0.3] + walk.tolist())
+    return all_games_scores
+
+
+def generate_player_stats(n_rows=1500, seed=0, accuracy_shift=0.0):
+    """Таблица метрик в формате players_stats.csv (с нормализованными колонками)"""
+    rng = np.random.default_rng(seed)
+    accuracy = np.clip(rng.normal(80 + accuracy_shift, 7, n_rows), 20, 100).round(1)
+    avg_loss = np.clip(rng.gamma(4, 20, n_rows) - accuracy_shift * 3, 1, None).round(1)
+    df = pd.DataFrame({
+        "Opponent": [f"opponent{i % 50}" for i in range(n_rows)],
+        "Color": np.where(np.arange(n_rows) % 2 == 0, "White", "Black"),
+        "Accuracy": accuracy,
+        "AvgLoss": avg_loss,
+        "Blunders": rng.poisson(2, n_rows),
+        "Mistakes": rng.poisson(3, n_rows),
+        "Inaccuracies": rng.poisson(4, n_rows),
+        "TotalMoves": rng.integers(20, 60, n_rows),
+    })
+    df["Normalized AvgLoss"] = df["AvgLoss"] ** 0.5
+    df["Normalized Accuracy"] = df["Accuracy"] ** 2
+    return df
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Воспроизводимые бенчмарки всех этапов конвейера, работают без сети.
+
+Этапы:
+    parse              - разбор PGN-потока, как в get_player_games
+    engine_stub        - analyze_games_with_engine с детерминированным движком-заглушкой
+    engine_stockfish   - то же с настоящим Stockfish (только с --stockfish PATH)
+    metrics_loop       - analyze_player_losses + покомпонентный цикл calculate_game_metrics
+    metrics_vectorized - calculate_metrics_vectorized
+    hypothesis_tests   - check_dispersion_equality + detecting_cheaters + непараметрический вариант
+
+Для каждого этапа выводятся время, партии/с, полуходы/с и пик памяти (tracemalloc).
+Результаты сравниваются с сохраненной базой (benchmarks/baseline.json): этап считается регрессией,
+если его скорость упала или пик памяти вырос больше чем на --tolerance.
+
+Примеры:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --stockfish /usr/games/stockfish
+    python benchmarks/run_benchmarks.py --save-baseline
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+# Путь к интерпретатору запоминаем до импорта модуля проекта
+PYTHON = sys.executable
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import chess.pgn                                      # noqa: E402
+
+import corpus                                         # noqa: E402
+import detecting_cheaters_on_lichess as dc            # noqa: E402
+
+STUB_ENGINE = [PYTHON, os.path.join(BENCHMARKS_DIR, "stub_engine.py")]
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+
+def measure(function, repeat=1):
+    """
+    Выполняет function repeat раз и возвращает (результат, лучшее время в секундах, пик памяти в МБ).
+    Пик памяти меряется отдельным запуском под tracemalloc, чтобы не искажать время.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, best, peak / 2 ** 20
+
+
+def stage_result(wall_time, peak_mb, games=None, plies=None):
+    result = {"wall_time": round(wall_time, 6), "peak_memory_mb": round(peak_mb, 3)}
+    if games is not None:
+        result["games_per_sec"] = round(games / wall_time, 3)
+    if plies is not None:
+        result["plies_per_sec"] = round(plies / wall_time, 3)
+    return result
+
+
+def parse_pgn(pgn_text):
+    games = []
+    for text in dc.iter_pgn_texts(pgn_text.splitlines()):
+        game = chess.pgn.read_game(io.StringIO(text))
+        if game:
+            games.append(game)
+    return games
+
+
+def run(args):
+    results = {}
+
+    games = corpus.generate_games(n_games=args.games, plies=args.plies, seed=args.seed)
+    pgn_text = corpus.games_to_pgn(games)
+    n_plies = sum(len(list(game.mainline_moves())) for game in games)
+
+    # 1. Разбор PGN
+    parsed, wall, peak = measure(lambda: parse_pgn(pgn_text), repeat=args.repeat)
+    assert len(parsed) == len(games)
+    results["parse"] = stage_result(wall, peak, games=len(games), plies=n_plies)
+
+    texts = list(dc.iter_pgn_texts(pgn_text.splitlines()))
+    parsed, wall, peak = measure(lambda: dc.parse_compact_games(texts), repeat=args.repeat)
+    assert len(parsed) == len(games)
+    results["parse_compact"] = stage_result(wall, peak, games=len(games), plies=n_plies)
+
+    # 2. Движок: заглушка на части корпуса (результат не зависит от скорости Stockfish)
+    engine_games = games[:args.engine_games]
+    engine_plies = sum(len(list(game.mainline_moves())) for game in engine_games)
+
+    def run_engine(engine_path):
+        with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
+            return dc.analyze_games_with_engine(engine_games, engine_path, depth=args.depth, n_engines=args.engines)
+
+    all_games_scores, wall, peak = measure(lambda: run_engine(STUB_ENGINE))
+    results["engine_stub"] = stage_result(wall, peak, games=len(engine_games), plies=engine_plies)
+
+    if args.stockfish:
+        _, wall, peak = measure(lambda: run_engine(args.stockfish))
+        results["engine_stockfish"] = stage_result(wall, peak, games=len(engine_games), plies=engine_plies)
+
+    # 3. Метрики: на синтетических оценках всего корпуса
+    metric_games = games
+    metric_scores = corpus.generate_scores(n_games=len(metric_games), plies=args.plies, seed=args.seed)
+    metric_plies = sum(len(scores) - 1 for scores in metric_scores)
+
+    def metrics_loop():
+        all_games_losses = dc.analyze_player_losses(metric_scores)
+        return [
+            dc.calculate_game_metrics(game, scores, losses, "player")
+            for game, scores, losses in zip(metric_games, metric_scores, all_games_losses)
+        ]
+
+    _, wall, peak = measure(metrics_loop, repeat=args.repeat)
+    results["metrics_loop"] = stage_result(wall, peak, games=len(metric_games), plies=metric_plies)
+
+    _, wall, peak = measure(lambda: dc.calculate_metrics_vectorized(metric_games, metric_scores, "player"), repeat=args.repeat)
+    results["metrics_vectorized"] = stage_result(wall, peak, games=len(metric_games), plies=metric_plies)
+
+    # 4. Проверка гипотез
+    baseline_stats = corpus.generate_player_stats(n_rows=args.baseline_rows, seed=args.seed)
+    suspect_stats = corpus.generate_player_stats(n_rows=args.suspect_rows, seed=args.seed + 1, accuracy_shift=3)
+
+    def hypothesis_tests():
+        with contextlib.redirect_stdout(io.StringIO()):
+            dc.detecting_cheaters(baseline_stats, suspect_stats)
+            dc.detecting_cheaters_if_distributions_are_not_normal(baseline_stats, suspect_stats)
+
+    _, wall, peak = measure(hypothesis_tests, repeat=args.repeat)
+    results["hypothesis_tests"] = stage_result(wall, peak)
+
+    return results, all_games_scores
+
+
+def compare(results, baseline, tolerance):
+    """Возвращает список регрессий относительно базы"""
+    regressions = []
+    for stage, current in results.items():
+        reference = baseline.get("stages", {}).get(stage)
+        if reference is None:
+            continue
+        for key in ("games_per_sec", "plies_per_sec"):
+            if key in current and key in reference and current[key] < reference[key] * (1 - tolerance):
+                regressions.append(f"{stage}: {key} {current[key]:.1f} < {reference[key]:.1f}")
+        if "games_per_sec" not in current and current["wall_time"] > reference["wall_time"] * (1 + tolerance):
+            regressions.append(f"{stage}: wall_time {current['wall_time']:.4f} > {reference['wall_time']:.4f}")
+        if current["peak_memory_mb"] > reference["peak_memory_mb"] * (1 + tolerance) + 1:
+            regressions.append(f"{stage}: peak_memory_mb {current['peak_memory_mb']:.1f} > {reference['peak_memory_mb']:.1f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки конвейера detecting_cheaters_on_lichess")
+    parser.add_argument("--games", type=int, default=200, help="Число партий синтетического корпуса")
+    parser.add_argument("--plies", type=int, default=80, help="Длина партий в полуходах")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine-games", type=int, default=40, help="Сколько партий анализировать движком")
+    parser.add_argument("--depth", type=int, default=10)
+    parser.add_argument("--engines", type=int, default=1, help="Число процессов движка")
+    parser.add_argument("--stockfish", help="Путь к Stockfish для дополнительного этапа с настоящим движком")
+    parser.add_argument("--baseline-rows", type=int, default=1500)
+    parser.add_argument("--suspect-rows", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3, help="Число повторов быстрых этапов (берется лучшее время)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Файл с базовыми результатами")
+    parser.add_argument("--save-baseline", action="store_true", help="Сохранить результаты как новую базу")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Допустимое ухудшение относительно базы")
+    parser.add_argument("--output", help="Записать результаты в JSON-файл")
+    args = parser.parse_args(argv)
+
+    results, _ = run(args)
+
+    print(f"{'stage':<20}{'wall, s':>10}{'games/s':>12}{'plies/s':>14}{'peak, MB':>10}")
+    for stage, result in results.items():
+        print(
+            f"{stage:<20}{result['wall_time']:>10.4f}{result.get('games_per_sec', float('nan')):>12.1f}"
+            f"{result.get('plies_per_sec', float('nan')):>14.1f}{result['peak_memory_mb']:>10.2f}"
+        )
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("baseline", "save_baseline", "output", "tolerance")},
+        "stages": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"База сохранена в {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("Базовых результатов нет, сравнение пропущено (--save-baseline, чтобы их сохранить)")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("parameters") != report["parameters"]:
+        print("Параметры запуска отличаются от базы, сравнение может быть некорректным")
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("РЕГРЕССИИ:")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+
+    print("Регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Детерминированный UCI-движок-заглушка для бенчмарков.
+
+Оценка позиции - материал плюс псевдослучайная добавка от хеша расстановки фигур, поэтому
+результат не зависит ни от глубины, ни от скорости машины, а время ответа почти постоянно.
+Понимает команды uci, isready, setoption, ucinewgame, position, go (depth/nodes/movetime), quit.
+"""
+
+import hashlib
+import sys
+
+import chess
+
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 310, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+
+def evaluate(board):
+    """Оценка позиции в сантипешках с точки зрения стороны, которая ходит"""
+    score = sum(
+        PIECE_VALUES[piece.piece_type] * (1 if piece.color == chess.WHITE else -1)
+        for piece in board.piece_map().values()
+    )
+    # Детерминированный "шум", чтобы оценки соседних позиций отличались
+    score += int(hashlib.md5(board.board_fen().encode()).hexdigest()[:4], 16) % 81 - 40
+    return score if board.turn == chess.WHITE else -score
+
+
+def parse_position(tokens):
+    if tokens[1] == "startpos":
+        board = chess.Board()
+        rest = tokens[2:]
+    else:
+        end = tokens.index("moves") if "moves" in tokens else len(tokens)
+        board = chess.Board(" ".join(tokens[2:end]))
+        rest = tokens[end:]
+    for move in rest[1:]:
+        board.push_uci(move)
+    return board
+
+
+def main():
+    board = chess.Board()
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command == "uci":
+            print("id name StubEngine")
+            print("option name Threads type spin default 1 min 1 max 512")
+            print("option name Hash type spin default 16 min 1 max 33554432")
+            print("uciok", flush=True)
+        elif command == "isready":
+            print("readyok", flush=True)
+        elif command == "position":
+            board = parse_position(tokens)
+        elif command == "go":
+            depth = int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else 1
+            nodes = int(tokens[tokens.index("nodes") + 1]) if "nodes" in tokens else 1000 * depth
+            best_move = next(iter(board.legal_moves), None)
+
+            if best_move is None:
+                score = "mate 0" if board.is_check() else "cp 0"
+                print(f"info depth 0 score {score}")
+                print("bestmove (none)", flush=True)
+                continue
+
+            print(f"info depth {depth} seldepth {depth} score cp {evaluate(board)} nodes {nodes} nps 1000000 time 1 pv {best_move.uci()}")
+            print(f"bestmove {best_move.uci()}", flush=True)
+        elif command == "quit":
+            break
+
+
+if __name__ == "__main__":
+    main()
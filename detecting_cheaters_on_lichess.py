@@ -1,38 +1,322 @@
 # -*- coding: utf-8 -*-
 """Detecting_cheaters_on_lichess.ipynb
-
+"""
 
 import sys
-sys.executable = "/usr/bin/python3.8"
-
-import berserk                                         # Библиотека для выгрузки шахматных партий
-import chess.pgn                                       # Библиотека для преобразования шахматных партий в формат PGN
-import pandas as pd
-from scipy import stats                                # Модуль для статистической обработки данных
-import numpy as np
-from datetime import datetime, timedelta
+import importlib
+import argparse                                        # Командная строка: fetch, analyze, test, report
+from datetime import datetime, timedelta, timezone
 import time
-from tqdm import tqdm                                  # Функция, позволяющая отобразить прогресс-бар с числом и процентом проанализированных партий
 import math
-import matplotlib.pyplot as plt
-import chess.engine                                    # Библиотека для работы с шахматным движком
-from statsmodels.graphics.gofplots import qqplot       # Функция, позволяющая визуализировать распределение данных относительно нормального
-from io import StringIO                                # Библиотека для прочтения PGN-файлов
+from io import StringIO, TextIOWrapper                 # Библиотека для прочтения PGN-файлов
+import queue
+import threading
+import sqlite3                                         # Хранилище для кеша оценок позиций
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor  # Потоки движков, процессы разбора PGN
+from collections import deque
+import bz2                                             # Чтение дампов Lichess .pgn.bz2
+import os
+import socket                                          # Имя узла в идентификаторе обработчика очереди
+import json
+import re
+from array import array                                # Компактное хранение ходов партии
+import contextlib
+import hashlib                                         # Ключ партии без идентификатора Lichess
+import contextvars                                     # Метки метрик (ник игрока), которые видят и потоки движков
+
+class _LazyModule:
+    """
+    Модуль, который импортируется при первом обращении к его атрибуту.
+    Тяжелые зависимости (pandas, scipy, matplotlib, berserk, python-chess) не замедляют импорт библиотеки
+    и загружаются только теми функциями и командами, которым они нужны.
+
+    Параметры:
+        name (str): Имя модуля
+        submodules (tuple): Подмодули, импортируемые вместе с ним (например, 'pgn' для chess)
+    """
+
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(f"{self._name}.{submodule}")
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+berserk = _LazyModule("berserk", ("utils",))          # Библиотека для выгрузки шахматных партий
+chess = _LazyModule("chess", ("pgn", "engine", "polyglot", "syzygy"))  # PGN, движок, книга и Zobrist-хеш, таблицы Syzygy
+pd = _LazyModule("pandas")
+stats = _LazyModule("scipy.stats")                     # Модуль для статистической обработки данных
+np = _LazyModule("numpy")
+plt = _LazyModule("matplotlib.pyplot")
+asyncio = _LazyModule("asyncio")                       # Одновременная выгрузка партий многих игроков
+requests = _LazyModule("requests", ("adapters",))
+_tqdm = _LazyModule("tqdm")
+_gofplots = _LazyModule("statsmodels.graphics.gofplots")
+
+def tqdm(*args, **kwargs):
+    """Прогресс-бар с числом и процентом проанализированных партий"""
+    return _tqdm.tqdm(*args, **kwargs)
+
+def qqplot(*args, **kwargs):
+    """QQ-plot: визуализирует распределение данных относительно нормального"""
+    return _gofplots.qqplot(*args, **kwargs)
+
+def show_or_save(fig, path=None):
+    """
+    Показывает график или, если задан path, сохраняет его в файл и закрывает фигуру (без GUI)
+    """
+    if path is None:
+        plt.show()
+    else:
+        fig.savefig(path, dpi=100)
+        plt.close(fig)
+
+"""# Инструментирование"""
+
+# Обработчики событий метрик: hook(event, data). Список пуст - события не формируются вообще
+_metrics_hooks = []
+_metrics_labels = contextvars.ContextVar("metrics_labels", default={})
+
+def add_metrics_hook(hook):
+    """
+    Подключает обработчик событий метрик. hook(event, data) вызывается для событий:
+        stage         - время этапа: stage ('fetch', 'parse', 'engine_search', 'metrics', 'statistical_test'), seconds
+        engine_search - один поиск движка: seconds, nodes, nps, depth
+        game          - анализ одной партии: seconds, plies
+        parse_error   - ошибка разбора PGN
+        cache         - состояние кеша: cache, hits, misses
+        schedule      - итог analyze_games_scheduled: naive_searches, positions, searches, removed
+    В data также добавляются метки из metrics_labels (например, player).
+    """
+    _metrics_hooks.append(hook)
+    return hook
+
+def remove_metrics_hook(hook):
+    """Отключает обработчик событий метрик"""
+    if hook in _metrics_hooks:
+        _metrics_hooks.remove(hook)
+
+def emit_metric(event, **data):
+    """Передает событие всем подключенным обработчикам"""
+    if not _metrics_hooks:
+        return
+    data = {**_metrics_labels.get(), **data}
+    for hook in list(_metrics_hooks):
+        try:
+            hook(event, data)
+        except Exception as e:
+            print(f"Ошибка в обработчике метрик: {e}")
+
+@contextlib.contextmanager
+def metrics_labels(**labels):
+    """Добавляет метки (например, player=username) ко всем событиям метрик внутри блока with"""
+    token = _metrics_labels.set({**_metrics_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _metrics_labels.reset(token)
+
+@contextlib.contextmanager
+def timed_stage(stage, **labels):
+    """Измеряет время блока with и отправляет событие stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        emit_metric("stage", stage=stage, seconds=time.perf_counter() - started, **labels)
+
+class MetricsCollector:
+    """
+    Обработчик событий метрик, который их агрегирует и сохраняет в JSON или текстовый файл Prometheus.
+
+    Пример:
+        collector = add_metrics_hook(MetricsCollector())
+        analyze_player_performance(...)
+        collector.write_prometheus('/var/lib/node_exporter/lichess.prom')
+
+    Параметры:
+        latency_buckets (tuple): Границы корзин гистограммы времени анализа партии (секунды)
+    """
+
+    def __init__(self, latency_buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300)):
+        self.latency_buckets = tuple(latency_buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}                           # stage -> {count, seconds, max_seconds}
+            self.player_stages = {}                    # (player, stage) -> seconds
+            self.game_latency = [0] * (len(self.latency_buckets) + 1)
+            self.game_latency_sum = 0.0
+            self.games = 0
+            self.plies = 0
+            self.engine_searches = 0
+            self.engine_nodes = 0
+            self.engine_seconds = 0.0
+            self.engine_depth_sum = 0
+            self.engine_depth_min = None
+            self.parse_errors = 0
+            self.caches = {}                           # cache -> {hits, misses}
+
+    def __call__(self, event, data):
+        with self._lock:
+            if event == "stage":
+                stage = self.stages.setdefault(data["stage"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+                stage["count"] += 1
+                stage["seconds"] += data["seconds"]
+                stage["max_seconds"] = max(stage["max_seconds"], data["seconds"])
+                if "player" in data:
+                    key = (data["player"], data["stage"])
+                    self.player_stages[key] = self.player_stages.get(key, 0.0) + data["seconds"]
+            elif event == "engine_search":
+                self.engine_searches += 1
+                self.engine_seconds += data["seconds"]
+                self.engine_nodes += data.get("nodes") or 0
+                depth = data.get("depth")
+                if depth is not None:
+                    self.engine_depth_sum += depth
+                    self.engine_depth_min = depth if self.engine_depth_min is None else min(self.engine_depth_min, depth)
+            elif event == "game":
+                self.games += 1
+                self.plies += data.get("plies", 0)
+                self.game_latency_sum += data["seconds"]
+                bucket = next((i for i, bound in enumerate(self.latency_buckets) if data["seconds"] <= bound), len(self.latency_buckets))
+                self.game_latency[bucket] += 1
+            elif event == "parse_error":
+                self.parse_errors += 1
+            elif event == "cache":
+                self.caches[data["cache"]] = {"hits": data["hits"], "misses": data["misses"]}
+
+    def summary(self):
+        """Возвращает агрегированные метрики словарем"""
+        with self._lock:
+            players = {}
+            for (player, stage), seconds in self.player_stages.items():
+                players.setdefault(player, {})[stage] = seconds
+            return {
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "players": players,
+                "games": self.games,
+                "plies": self.plies,
+                "game_latency": {
+                    "buckets": dict(zip([str(bound) for bound in self.latency_buckets] + ["+Inf"], self.game_latency)),
+                    "sum": self.game_latency_sum,
+                    "count": self.games
+                },
+                "engine": {
+                    "searches": self.engine_searches,
+                    "nodes": self.engine_nodes,
+                    "seconds": self.engine_seconds,
+                    "nps": self.engine_nodes / self.engine_seconds if self.engine_seconds else 0.0,
+                    "avg_depth": self.engine_depth_sum / self.engine_searches if self.engine_searches else 0.0,
+                    "min_depth": self.engine_depth_min
+                },
+                "parse_errors": self.parse_errors,
+                "caches": {
+                    name: {**counts, "hit_rate": counts["hits"] / (counts["hits"] + counts["misses"]) if counts["hits"] + counts["misses"] else 0.0}
+                    for name, counts in self.caches.items()
+                }
+            }
+
+    @staticmethod
+    def _write_atomic(path, text):
+        # Пишем через временный файл, чтобы сборщик никогда не прочитал файл наполовину
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def write_json(self, path):
+        """Сохраняет метрики в JSON"""
+        self._write_atomic(path, json.dumps(self.summary(), indent=2, ensure_ascii=False))
+
+    def to_prometheus(self, prefix="lichess"):
+        """Возвращает метрики в текстовом формате Prometheus"""
+        summary = self.summary()
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape(label)}"' for key, label in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        metric("stage_seconds_total", "counter", "Total wall time per pipeline stage",
+               [({"stage": name}, stage["seconds"]) for name, stage in summary["stages"].items()])
+        metric("stage_calls_total", "counter", "Number of timed runs per pipeline stage",
+               [({"stage": name}, stage["count"]) for name, stage in summary["stages"].items()])
+        metric("stage_max_seconds", "gauge", "Longest single run per pipeline stage",
+               [({"stage": name}, stage["max_seconds"]) for name, stage in summary["stages"].items()])
+        metric("player_stage_seconds_total", "counter", "Total wall time per player and stage",
+               [({"player": player, "stage": stage}, seconds)
+                for player, stages in summary["players"].items() for stage, seconds in stages.items()])
+
+        # Гистограмма времени анализа партии (накопительные корзины)
+        lines.append(f"# HELP {prefix}_game_latency_seconds Engine analysis time per game")
+        lines.append(f"# TYPE {prefix}_game_latency_seconds histogram")
+        cumulative = 0
+        for bound, count in summary["game_latency"]["buckets"].items():
+            cumulative += count
+            lines.append(f'{prefix}_game_latency_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{prefix}_game_latency_seconds_sum {summary['game_latency']['sum']}")
+        lines.append(f"{prefix}_game_latency_seconds_count {summary['game_latency']['count']}")
+
+        engine = summary["engine"]
+        metric("plies_total", "counter", "Analyzed plies", [({}, summary["plies"])])
+        metric("engine_searches_total", "counter", "Engine searches", [({}, engine["searches"])])
+        metric("engine_nodes_total", "counter", "Nodes searched by the engine", [({}, engine["nodes"])])
+        metric("engine_search_seconds_total", "counter", "Wall time spent in engine searches", [({}, engine["seconds"])])
+        metric("engine_nodes_per_second", "gauge", "Average engine speed", [({}, engine["nps"])])
+        metric("engine_depth_average", "gauge", "Average depth actually reached", [({}, engine["avg_depth"])])
+        if engine["min_depth"] is not None:
+            metric("engine_depth_min", "gauge", "Minimum depth actually reached", [({}, engine["min_depth"])])
+        metric("parse_failures_total", "counter", "PGN parse failures", [({}, summary["parse_errors"])])
+        metric("cache_hits_total", "counter", "Cache hits", [({"cache": name}, cache["hits"]) for name, cache in summary["caches"].items()])
+        metric("cache_misses_total", "counter", "Cache misses", [({"cache": name}, cache["misses"]) for name, cache in summary["caches"].items()])
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="lichess"):
+        """Сохраняет метрики в текстовый файл Prometheus (для textfile collector node_exporter)"""
+        self._write_atomic(path, self.to_prometheus(prefix=prefix))
 
 """# Задание функций"""
 
-def get_player_games(username, days=365, perf_type="blitz", end_date=None, token='your_token'):
+def iter_player_games(username, days=365, perf_type="blitz", end_date=None, token='your_token', since=None, evals=None, compact=False, until=None):
     """
-    Получает партии игрока за указанное количество месяцев
+    Генератор партий игрока: каждая партия разбирается и отдается сразу, как только приходит из потока Lichess
 
     Параметры:
         username (str): Ник игрока на Lichess
         days (int): Количество дней для выборки
         perf_type (str): Тип игры ('blitz', 'bullet', 'rapid' и т.д.)
         end_date (datetime): Конечная дата выборки (по умолчанию текущая дата)
+        since (datetime или int): Начало выборки (datetime или миллисекунды); если задано, заменяет end_date - days
+        evals (bool): Запросить серверные оценки [%eval ...] для проанализированных партий
+        compact (bool): Разбирать партии в CompactGame (быстрее и меньше памяти; достаточно для анализа)
+        until (datetime или int): Конец выборки (datetime или миллисекунды; None - без ограничения)
 
     Возвращает:
-        list: Список объектов chess.pgn.Game
+        generator: Объекты chess.pgn.Game (или CompactGame)
     """
 
     # Объект, который управляет HTTP-сессией и добавляет ваш API-токен к каждому запросу.
@@ -50,82 +334,1802 @@ def get_player_games(username, days=365, perf_type="blitz", end_date=None, token
             print(f"Неверный формат даты. Используйте 'YYYY-MM-DD'. Ошибка: {e}")
             end_date = datetime.now()
 
-    start_date = end_date - timedelta(days=days)
+    if since is None:
+        since = end_date - timedelta(days=days)
+    if isinstance(since, datetime):
+        since = berserk.utils.to_millis(since)
+    if isinstance(until, datetime):
+        until = berserk.utils.to_millis(until)
+
+    # Получаем генератор PGN-текстов
+    pgn_generator = client.games.export_by_player(
+        username,
+        since=since,
+        until=until,
+        perf_type=perf_type,
+        evals=evals,
+        as_pgn=True
+    )
+
+    # Читаем PGN через StringIO
+    pgn_iterator = iter(pgn_generator)
+    while True:
+        # Время ожидания следующей партии из сети - этап fetch
+        with timed_stage("fetch", player=username):
+            pgn_text = next(pgn_iterator, None)
+        if pgn_text is None:
+            break
+
+        try:
+            with timed_stage("parse", player=username):
+                if compact:
+                    game = read_compact_game(pgn_text)
+                else:
+                    pgn_io = StringIO(pgn_text)
+                    game = chess.pgn.read_game(pgn_io)
+            if game:
+                yield game
+        except Exception as e:
+            print(f"Ошибка при разборе PGN: {e}")
+            emit_metric("parse_error", player=username)
+            continue
 
+def get_player_games(username, days=365, perf_type="blitz", end_date=None, token='your_token', since=None, evals=None, compact=False):
+    """
+    Получает партии игрока за указанное количество месяцев
+
+    Параметры:
+        username (str): Ник игрока на Lichess
+        days (int): Количество дней для выборки
+        perf_type (str): Тип игры ('blitz', 'bullet', 'rapid' и т.д.)
+        end_date (datetime): Конечная дата выборки (по умолчанию текущая дата)
+        since (datetime или int): Начало выборки (datetime или миллисекунды); если задано, заменяет end_date - days
+        evals (bool): Запросить серверные оценки [%eval ...] для проанализированных партий
+        compact (bool): Разбирать партии в CompactGame (быстрее и меньше памяти; достаточно для анализа)
+
+    Возвращает:
+        list: Список объектов chess.pgn.Game (или CompactGame)
+    """
     try:
-        # Получаем генератор PGN-текстов
-        pgn_generator = client.games.export_by_player(
-            username,
-            since=berserk.utils.to_millis(start_date),
-            perf_type=perf_type,
-            as_pgn=True
+        return list(iter_player_games(username, days=days, perf_type=perf_type, end_date=end_date, token=token, since=since, evals=evals, compact=compact))
+
+    except Exception as e:
+        print(f"Ошибка при получении партий: {e}")
+
+def open_pgn_dump(path):
+    """
+    Открывает (сжатый) PGN-файл как бинарный поток: .pgn.zst, .pgn.bz2 или несжатый .pgn
+    """
+    if path.endswith(".zst"):
+        try:
+            import zstandard                           # Необязательная зависимость, нужна только для дампов .zst
+        except ImportError:
+            raise ImportError("Для чтения .pgn.zst установите пакет zstandard: pip install zstandard")
+        # Дампы Lichess сжаты с окном больше значения по умолчанию
+        decompressor = zstandard.ZstdDecompressor(max_window_size=2 ** 31)
+        return decompressor.stream_reader(open(path, "rb"), closefd=True)
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+def perf_type_from_headers(headers):
+    """
+    Определяет тип игры ('bullet', 'blitz', ...) по заголовкам TimeControl/Event, как это делает Lichess
+    """
+    time_control = headers.get("TimeControl", "")
+    if time_control == "-":
+        return "correspondence"
+    if "+" in time_control:
+        base, increment = time_control.split("+", 1)
+        try:
+            # Оценка длительности партии по правилам Lichess: база + 40 * добавление
+            estimated = int(base) + 40 * int(increment)
+        except ValueError:
+            estimated = None
+        if estimated is not None:
+            if estimated < 30:
+                return "ultraBullet"
+            if estimated < 180:
+                return "bullet"
+            if estimated < 480:
+                return "blitz"
+            if estimated < 1500:
+                return "rapid"
+            return "classical"
+
+    event = headers.get("Event", "").lower()
+    for perf_type in ("ultrabullet", "bullet", "blitz", "rapid", "classical", "correspondence"):
+        if perf_type in event:
+            return "ultraBullet" if perf_type == "ultrabullet" else perf_type
+    return None
+
+_LICHESS_SITE_REGEX = re.compile(r"^https?://(?:[a-z]+\.)?lichess\.org/([A-Za-z0-9]{8})")
+
+def game_id_from_headers(headers):
+    """
+    Возвращает идентификатор партии Lichess из заголовка Site (https://lichess.org/<id>) или GameId.
+    Для партий не с Lichess (Site "?", турнир за доской, другой сайт) возвращает пустую строку
+    """
+    match = _LICHESS_SITE_REGEX.match(headers.get("Site", ""))
+    if match:
+        return match.group(1)
+    return headers.get("GameId", "")
+
+def game_key(game):
+    """
+    Ключ для отбрасывания повторов партии: идентификатор Lichess, а если его нет - хеш заголовков COMPACT_HEADERS
+    и ходов основной линии (одинаковый у chess.pgn.Game и CompactGame одной партии)
+    """
+    game_id = game_id_from_headers(game.headers)
+    if game_id:
+        return game_id
+    content = hashlib.sha1()
+    for key in COMPACT_HEADERS:
+        content.update(f"{game.headers.get(key, '')}\x00".encode())
+    content.update(" ".join(move.uci() for move in game.mainline_moves()).encode())
+    return "sha1:" + content.hexdigest()
+
+def game_time_from_headers(headers):
+    """
+    Возвращает время начала партии из заголовков UTCDate/UTCTime в миллисекундах (None, если заголовков нет)
+    """
+    try:
+        played_at = datetime.strptime(
+            f"{headers.get('UTCDate', '')} {headers.get('UTCTime', '00:00:00')}", '%Y.%m.%d %H:%M:%S'
         )
+    except ValueError:
+        return None
+    return int(played_at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def _parse_pgn_headers(block):
+    headers = {}
+    for line in block.split(b"\n"):
+        if not line.startswith(b"["):
+            if headers:
+                break
+            continue
+        key, _, value = line[1:].partition(b" ")
+        headers[key.decode("utf-8", "replace")] = value.rstrip(b"]").strip(b'"').decode("utf-8", "replace")
+    return headers
 
-        # Читаем PGN через StringIO
-        games = []
-        for pgn_text in pgn_generator:
+def iter_lichess_dump(path, username=None, perf_type=None, start_date=None, end_date=None, chunk_size=1 << 22, compact=False):
+    """
+    Потоково читает месячный дамп партий Lichess (https://database.lichess.org) с локального диска,
+    не распаковывая файл целиком, и отдает только подходящие под фильтры партии.
+
+    Файл читается большими блоками и делится на партии по заголовку [Event; ник игрока сначала ищется
+    простым поиском подстроки по байтам, поэтому полностью разбираются только подходящие партии.
+
+    Параметры:
+        path (str): Путь к дампу (.pgn.zst, .pgn.bz2 или .pgn)
+        username (str): Ник игрока (в написании, как в PGN), None - все партии
+        perf_type (str): Тип игры ('blitz', 'bullet', 'rapid' и т.д.), None - все типы
+        start_date (str или datetime): Начальная дата ('YYYY-MM-DD'), включительно
+        end_date (str или datetime): Конечная дата ('YYYY-MM-DD'), включительно
+        chunk_size (int): Размер блока чтения в байтах
+        compact (bool): Разбирать партии в CompactGame вместо chess.pgn.Game
+
+    Возвращает:
+        generator: Объекты chess.pgn.Game (или CompactGame), совместимые с analyze_games_with_engine
+    """
+    # Даты в PGN записаны как 'YYYY.MM.DD', поэтому их можно сравнивать как строки
+    def to_pgn_date(date):
+        if date is None:
+            return None
+        if isinstance(date, str):
+            date = datetime.strptime(date, '%Y-%m-%d')
+        return date.strftime('%Y.%m.%d')
+
+    start_date = to_pgn_date(start_date)
+    end_date = to_pgn_date(end_date)
+    needle = f'"{username}"]'.encode("utf-8") if username else None
+    separator = b"\n\n[Event "
+
+    def select(block):
+        if needle is not None and needle not in block:
+            return None
+
+        headers = _parse_pgn_headers(block)
+        if username and username not in (headers.get("White"), headers.get("Black")):
+            return None
+        if perf_type and perf_type_from_headers(headers) != perf_type:
+            return None
+        date = headers.get("UTCDate") or headers.get("Date", "")
+        if start_date and date < start_date:
+            return None
+        if end_date and date > end_date:
+            return None
+
+        try:
+            with timed_stage("parse"):
+                if compact:
+                    return read_compact_game(block)
+                return chess.pgn.read_game(StringIO(block.decode("utf-8", "replace")))
+        except Exception as e:
+            print(f"Ошибка при разборе PGN: {e}")
+            emit_metric("parse_error")
+            return None
+
+    with open_pgn_dump(path) as stream:
+        remainder = b""
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+
+            blocks = (remainder + chunk).split(separator)
+            remainder = blocks.pop()
+            for block in blocks:
+                if not block.startswith(b"[Event "):
+                    block = b"[Event " + block
+                game = select(block)
+                if game is not None:
+                    yield game
+
+            if remainder and not remainder.startswith(b"[Event "):
+                remainder = b"[Event " + remainder
+
+        if remainder.strip():
+            game = select(remainder)
+            if game is not None:
+                yield game
+
+def iter_tournament_games(tournament_id, token='your_token'):
+    """
+    Генератор партий арена-турнира Lichess
+
+    Параметры:
+        tournament_id (str): Идентификатор турнира (https://lichess.org/tournament/<id>)
+
+    Возвращает:
+        generator: Объекты chess.pgn.Game
+    """
+    client = berserk.Client(berserk.TokenSession(token))
+
+    # В новых версиях berserk метод называется export_arena_games, в 0.10 - export_games
+    export = getattr(client.tournaments, "export_arena_games", None) or client.tournaments.export_games
+
+    for pgn_text in export(tournament_id, as_pgn=True):
+        try:
+            game = chess.pgn.read_game(StringIO(pgn_text))
+            if game:
+                yield game
+        except Exception as e:
+            print(f"Ошибка при разборе PGN: {e}")
+            emit_metric("parse_error")
+            continue
+
+def iter_pgn_texts(lines):
+    """
+    Делит поток строк PGN (например, ответ Lichess) на тексты отдельных партий
+    """
+    current = []
+    in_moves = False
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        if line.startswith("[") and in_moves:
+            yield "\n".join(current)
+            current = []
+            in_moves = False
+        elif line.strip() and not line.startswith("["):
+            in_moves = True
+        current.append(line)
+    if any(line.strip() for line in current):
+        yield "\n".join(current)
+
+"""# Компактные партии"""
+
+# Заголовки, которые нужны анализу: игроки, идентификатор, дата, контроль времени, тип игры, рейтинги, стартовая позиция
+COMPACT_HEADERS = (
+    "Event", "Site", "GameId", "Date", "UTCDate", "UTCTime", "White", "Black", "WhiteElo", "BlackElo",
+    "Result", "TimeControl", "Variant", "SetUp", "FEN"
+)
+
+_HEADER_REGEX = re.compile(r'^\[([A-Za-z0-9_]+)\s+"(.*)"\]\s*$')
+_MOVETEXT_REGEX = re.compile(r"\{[^}]*\}?|;[^\n]*|\(|\)|\$\d+|[^\s{}();$]+")
+_MOVE_NUMBER_REGEX = re.compile(r"^\d+\.+")
+_RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+class CompactGame:
+    """
+    Компактная запись партии: только нужные анализу заголовки и ходы основной линии.
+
+    Ходы хранятся в array('H') по 2 байта (from | to << 6 | promotion << 12), оценки [%eval ...] после ходов -
+    в array('d') в пешках (как в analyze_games_with_engine, NaN - нет оценки) или None, если оценок в партии нет.
+    Варианты, NAG и остальные комментарии не сохраняются. Объект принимается везде, где принимается chess.pgn.Game:
+    есть headers, board(), mainline_moves() и str() (PGN основной линии).
+    """
+
+    __slots__ = ("headers", "moves", "evals", "errors")
+
+    def __init__(self, headers, moves, evals=None, errors=None):
+        self.headers = headers
+        self.moves = moves
+        self.evals = evals
+        self.errors = errors or []
+
+    def board(self):
+        """Начальная позиция партии (с учетом заголовков FEN и Variant)"""
+        return chess.pgn.Headers(self.headers).board()
+
+    def mainline_moves(self):
+        """Ходы основной линии (список chess.Move)"""
+        return [
+            chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None)
+            for code in self.moves
+        ]
+
+    def eval_scores(self):
+        """Оценки [%eval ...] после каждого хода в пешках (None - нет оценки)"""
+        if self.evals is None:
+            return [None] * len(self.moves)
+        return [None if score != score else score for score in self.evals]
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __str__(self):
+        header_lines = [f'[{key} "{value}"]' for key, value in self.headers.items()]
+        board = self.board()
+        tokens = []
+        for ply, (move, score) in enumerate(zip(self.mainline_moves(), self.eval_scores())):
+            if board.turn == chess.WHITE:
+                tokens.append(f"{board.fullmove_number}.")
+            elif ply == 0:
+                tokens.append(f"{board.fullmove_number}...")
+            tokens.append(board.san(move))
+            board.push(move)
+            if score is not None:
+                tokens.append(f"{{ [%eval {score:.2f}] }}")
+        tokens.append(self.headers.get("Result", "*"))
+        return "\n".join(header_lines) + "\n\n" + " ".join(tokens)
+
+def read_compact_game(pgn_text):
+    """
+    Быстро разбирает одну партию в CompactGame без построения дерева chess.pgn.Game.
+
+    Заголовки берутся только из COMPACT_HEADERS, варианты пропускаются, из комментариев основной линии
+    извлекается только [%eval ...]. На нелегальном ходе разбор основной линии останавливается
+    (как в chess.pgn.read_game), ошибка записывается в errors.
+
+    Параметры:
+        pgn_text (str или bytes): Текст PGN одной партии
+
+    Возвращает:
+        CompactGame: Партия или None, если текст пустой
+    """
+    if isinstance(pgn_text, bytes):
+        pgn_text = pgn_text.decode("utf-8", "replace")
+
+    headers = {}
+    movetext_start = len(pgn_text)
+    position = 0
+    for line in pgn_text.splitlines(True):
+        stripped = line.strip()
+        if stripped.startswith("[") and movetext_start == len(pgn_text):
+            match = _HEADER_REGEX.match(stripped)
+            if match:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"')
+        elif stripped and not stripped.startswith("%"):
+            movetext_start = position
+            break
+        position += len(line)
+
+    if not headers and movetext_start == len(pgn_text):
+        return None
+
+    board = chess.pgn.Headers(headers).board()
+    compact_headers = {key: headers[key] for key in COMPACT_HEADERS if key in headers}
+    for key, default in (("Event", "?"), ("Site", "?"), ("Date", "????.??.??"), ("White", "?"), ("Black", "?"), ("Result", "*")):
+        compact_headers.setdefault(key, default)
+
+    moves = array("H")
+    evals = None
+    errors = []
+    depth = 0
+    for match in _MOVETEXT_REGEX.finditer(pgn_text, movetext_start):
+        token = match.group(0)
+        first = token[0]
+        if first == "{":
+            # Комментарий после хода основной линии: берем первую оценку [%eval ...]
+            if depth == 0 and moves and not errors and "[%eval" in token:
+                if evals is None:
+                    evals = array("d", [float("nan")] * len(moves))
+                eval_match = chess.pgn.EVAL_REGEX.search(token)
+                if eval_match and evals[-1] != evals[-1]:
+                    evals[-1] = _eval_match_to_pawns(eval_match, board.turn)
+            continue
+        if first == "(":
+            depth += 1
+            continue
+        if first == ")":
+            depth = max(depth - 1, 0)
+            continue
+        if depth or first in ";$" or errors:
+            continue
+        if token in _RESULTS:
+            break
+
+        san = _MOVE_NUMBER_REGEX.sub("", token).rstrip("!?")
+        if not san:
+            continue
+        try:
+            move = board.push_san(san)
+        except ValueError as e:
+            errors.append(e)
+            continue
+        moves.append(move.from_square | move.to_square << 6 | (move.promotion or 0) << 12)
+        if evals is not None:
+            evals.append(float("nan"))
+
+    return CompactGame(compact_headers, moves, evals, errors)
+
+def _eval_match_to_pawns(match, turn):
+    """Оценка [%eval ...] в пешках - так же, как chess.pgn.GameNode.eval() и score_to_pawns. turn - очередь хода после хода"""
+    if match.group("mate"):
+        mate = int(match.group("mate"))
+        score = chess.engine.Mate(mate)
+        if mate == 0:
+            return score_to_pawns(chess.engine.PovScore(score, turn))
+    else:
+        score = chess.engine.Cp(round(float(match.group("cp")) * 100))
+    return score_to_pawns(chess.engine.PovScore(score if turn else -score, turn))
+
+def parse_compact_games(pgn_texts, processes=None, chunksize=64):
+    """
+    Разбирает тексты партий в CompactGame, при processes > 1 - параллельно в нескольких процессах
+
+    Параметры:
+        pgn_texts (iterable): Тексты PGN отдельных партий (str или bytes)
+        processes (int): Число процессов (None или 1 - в текущем процессе)
+        chunksize (int): Сколько партий отдавать процессу за раз
+
+    Возвращает:
+        list: Список CompactGame (пустые тексты пропускаются)
+    """
+    with timed_stage("parse"):
+        if processes is None or processes <= 1:
+            games = [read_compact_game(pgn_text) for pgn_text in pgn_texts]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                games = list(executor.map(read_compact_game, pgn_texts, chunksize=chunksize))
+    return [game for game in games if game is not None]
+
+def iter_mainline_evals(game, with_evals=False):
+    """
+    Ходы основной линии партии (chess.pgn.Game или CompactGame) и оценки [%eval ...] после них
+
+    Возвращает:
+        generator: Пары (chess.Move, оценка в пешках или None); без with_evals оценка всегда None
+    """
+    if isinstance(game, CompactGame):
+        scores = game.eval_scores() if with_evals else [None] * len(game.moves)
+        yield from zip(game.mainline_moves(), scores)
+        return
+    for node in game.mainline():
+        score = node.eval() if with_evals else None
+        yield node.move, (score_to_pawns(score) if score is not None else None)
+
+class LichessFetcher:
+    """
+    Асинхронная выгрузка партий многих игроков Lichess одновременно.
+
+    Все запросы идут через одну requests.Session с пулом соединений, число одновременных выгрузок
+    ограничено max_concurrency. При ответе 429 все выгрузки приостанавливаются на время из Retry-After
+    (по умолчанию на минуту, как требует Lichess) и затем повторяются.
+    Партии разбираются по мере поступления строк ответа тем же chess.pgn.read_game, что и в get_player_games.
+
+    Параметры:
+        token (str): API-токен Lichess (None - без авторизации)
+        base_url (str): Адрес API (для тестов можно указать локальный сервер)
+        max_concurrency (int): Максимальное число одновременных запросов
+        max_retries (int): Сколько раз повторять запрос после 429 или сетевой ошибки
+        rate_limit_wait (float): Пауза после 429, если сервер не прислал Retry-After (секунды)
+    """
+
+    def __init__(self, token=None, base_url="https://lichess.org", max_concurrency=4, max_retries=5, rate_limit_wait=60):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.rate_limit_wait = rate_limit_wait
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept"] = "application/x-chess-pgn"
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._pause_lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def _wait_for_rate_limit(self):
+        while True:
+            with self._pause_lock:
+                delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def _pause(self, seconds):
+        with self._pause_lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _fetch_blocking(self, username, params):
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            try:
+                with self.session.get(f"{self.base_url}/api/games/user/{username}", params=params, stream=True, timeout=60) as response:
+                    if response.status_code == 429:
+                        # Превышен лимит запросов: останавливаем все выгрузки, а не только эту
+                        retry_after = response.headers.get("Retry-After")
+                        self._pause(float(retry_after) if retry_after else self.rate_limit_wait)
+                        continue
+                    response.raise_for_status()
+
+                    games = []
+                    for pgn_text in iter_pgn_texts(response.iter_lines()):
+                        try:
+                            with timed_stage("parse", player=username):
+                                game = chess.pgn.read_game(StringIO(pgn_text))
+                            if game:
+                                games.append(game)
+                        except Exception as e:
+                            print(f"Ошибка при разборе PGN: {e}")
+                            emit_metric("parse_error", player=username)
+                    return games
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Ошибка при получении партий {username}: {e}, повтор")
+                time.sleep(min(2 ** attempt, 30))
+
+        raise RuntimeError(f"Не удалось получить партии {username}: превышен лимит запросов Lichess")
+
+    async def fetch_player_games(self, username, since=None, until=None, perf_type=None, max_games=None):
+        """
+        Выгружает партии одного игрока (параметры как у export_by_player; since/until в миллисекундах)
+
+        Возвращает:
+            list: Список объектов chess.pgn.Game
+        """
+        params = {"since": since, "until": until, "perfType": perf_type, "max": max_games}
+        params = {key: value for key, value in params.items() if value is not None}
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        games = await loop.run_in_executor(self._executor, self._fetch_blocking, username, params)
+        emit_metric("stage", stage="fetch", seconds=time.perf_counter() - started, player=username)
+        return games
+
+    async def fetch_many(self, usernames, **params):
+        """
+        Выгружает партии многих игроков одновременно.
+
+        Возвращает:
+            dict: Ник игрока -> список партий (пустой список, если выгрузка не удалась)
+        """
+        async def fetch(username):
             try:
-                pgn_io = StringIO(pgn_text)
-                game = chess.pgn.read_game(pgn_io)
-                if game:
-                    games.append(game)
+                return await self.fetch_player_games(username, **params)
             except Exception as e:
-                print(f"Ошибка при разборе PGN: {e}")
+                print(f"Ошибка при получении партий {username}: {e}")
+                return []
+
+        results = await asyncio.gather(*(fetch(username) for username in usernames))
+        return dict(zip(usernames, results))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+def fetch_players_games(usernames, days=365, perf_type="blitz", end_date=None, token='your_token', max_concurrency=4, base_url="https://lichess.org"):
+    """
+    Выгружает партии многих игроков одновременно (синхронная обертка над LichessFetcher)
+
+    Параметры:
+        usernames (list): Ники игроков
+        days, perf_type, end_date, token: Как в get_player_games
+        max_concurrency (int): Максимальное число одновременных запросов
+
+    Возвращает:
+        dict: Ник игрока -> список объектов chess.pgn.Game
+    """
+    if end_date is None:
+        end_date = datetime.now()
+    elif isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, '%Y-%m-%d')
+    since = berserk.utils.to_millis(end_date - timedelta(days=days))
+
+    async def run():
+        fetcher = LichessFetcher(token=token, base_url=base_url, max_concurrency=max_concurrency)
+        try:
+            return await fetcher.fetch_many(usernames, since=since, perf_type=perf_type)
+        finally:
+            fetcher.close()
+
+    return asyncio.run(run())
+
+# !which stockfish || find / -name stockfish 2>/dev/null | head -5
+
+def open_engine(engine_path='/usr/games/stockfish', threads=None, hash_mb=None):
+    """
+    Запускает UCI-движок и выставляет ему опции Threads/Hash.
+
+    Параметры:
+        engine_path (str): Путь к исполняемому файлу шахматного движка
+        threads (int): Число потоков движка (None - значение движка по умолчанию)
+        hash_mb (int): Размер хеш-таблицы движка в МБ (None - значение движка по умолчанию)
+
+    Возвращает:
+        chess.engine.SimpleEngine: Запущенный движок
+    """
+    engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+
+    options = {}
+    if threads is not None:
+        options["Threads"] = threads
+    if hash_mb is not None:
+        options["Hash"] = hash_mb
+    if options:
+        engine.configure(options)
+
+    return engine
+
+def score_to_pawns(score):
+    """
+    Переводит оценку движка (chess.engine.PovScore) в пешки с точки зрения белых, ограничивая диапазон ±10 пешками
+    """
+    score = score.white().score(mate_score=10000)  # Увеличим mate_score для надежности
+
+    if score is None:
+        return 0.0
+
+    # Правильное масштабирование оценки (делим на 100, так как 1 пешка = 100 единиц)
+    normalized_score = score / 100
+    # Ограничиваем диапазон для избежания экстремальных значений
+    return min(max(normalized_score, -10), 10)  # ±10 пешек
+
+class EvalCache:
+    """
+    Постоянный кеш оценок позиций на диске (SQLite).
+
+    Ключ - Zobrist-хеш позиции, значение - оценка в пешках (как в analyze_games_with_engine) и глубина,
+    на которой она была получена. Запись переиспользуется, если ее глубина не меньше запрошенной.
+    При превышении max_entries удаляются давно не использовавшиеся записи: время использования обновляется
+    и при записи, и при попадании (попадания копятся и сбрасываются на диск вместе с новыми записями).
+    Один объект можно использовать из нескольких потоков, один файл - из нескольких процессов.
+
+    Параметры:
+        path (str): Путь к файлу кеша
+        max_entries (int): Максимальное число позиций в кеше
+        flush_every (int): Через сколько новых записей сбрасывать их на диск
+    """
+
+    def __init__(self, path='eval_cache.sqlite', max_entries=1000000, flush_every=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._touched = {}                             # ключ -> время последнего попадания, еще не записанное на диск
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS evals ("
+            "key INTEGER PRIMARY KEY, score REAL NOT NULL, depth INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS evals_last_used ON evals (last_used)")
+        connection.commit()
+        # Оценка числа строк сверху (обновления считаются как вставки, записи других процессов не видны);
+        # точный COUNT(*) выполняется только когда оценка превышает max_entries
+        self._rows = connection.execute("SELECT COUNT(*) FROM evals").fetchone()[0]
+
+    def _connection(self):
+        # У каждого потока свое соединение: sqlite3-соединения нельзя разделять между потоками
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60)
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _key(board):
+        # Zobrist-хеш беззнаковый 64-битный, а INTEGER в SQLite - знаковый
+        key = chess.polyglot.zobrist_hash(board)
+        return key - (1 << 64) if key >= (1 << 63) else key
+
+    def get(self, board, depth):
+        """
+        Возвращает оценку позиции из кеша или None, если позиции нет или она посчитана на меньшей глубине
+        """
+        key = self._key(board)
+        row = self._connection().execute(
+            "SELECT score, depth FROM evals WHERE key = ?", (key,)
+        ).fetchone()
+
+        with self._lock:
+            if row is None or row[1] < depth:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._pending) + len(self._touched) < self.flush_every:
+                return row[0]
+            pending, self._pending = self._pending, []
+            touched, self._touched = self._touched, {}
+        self._write(pending, touched)
+        return row[0]
+
+    def put(self, board, score, depth):
+        """
+        Сохраняет оценку позиции (запись с большей глубиной не перезаписывается более мелкой)
+        """
+        with self._lock:
+            self._pending.append((self._key(board), score, depth, time.time()))
+            if len(self._pending) + len(self._touched) < self.flush_every:
+                return
+            pending, self._pending = self._pending, []
+            touched, self._touched = self._touched, {}
+        self._write(pending, touched)
+
+    def flush(self):
+        """Сбрасывает накопленные записи и времена попаданий на диск"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            touched, self._touched = self._touched, {}
+        if pending or touched:
+            self._write(pending, touched)
+
+    def _write(self, rows, touched=None):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT INTO evals (key, score, depth, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET score = excluded.score, depth = excluded.depth, last_used = excluded.last_used "
+                "WHERE excluded.depth >= evals.depth",
+                rows
+            )
+            if touched:
+                connection.executemany(
+                    "UPDATE evals SET last_used = MAX(last_used, ?) WHERE key = ?",
+                    [(used, key) for key, used in touched.items()]
+                )
+            # Вытесняем самые старые записи, оставляя запас в 10%, чтобы не чистить кеш на каждой записи
+            with self._lock:
+                self._rows += len(rows)
+                check = self._rows > self.max_entries
+            if not check:
+                return
+            count = connection.execute("SELECT COUNT(*) FROM evals").fetchone()[0]
+            if count > self.max_entries:
+                excess = count - int(self.max_entries * 0.9)
+                connection.execute(
+                    "DELETE FROM evals WHERE key IN (SELECT key FROM evals ORDER BY last_used LIMIT ?)", (excess,)
+                )
+                count -= excess
+            with self._lock:
+                self._rows = count
+
+    def stats(self):
+        """Возвращает словарь с числом попаданий и промахов кеша"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def close(self):
+        self.flush()
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+class OpeningIndex:
+    """
+    Индекс дебютных позиций, построенный по собственному корпусу партий.
+
+    Для позиций первых max_ply полуходов хранится, в скольких партиях они встретились, и сумма их оценок
+    (если партии уже проанализированы). Позиция, встретившаяся не менее чем в min_games партиях, считается
+    известной теорией: ее оценка - средняя оценка из корпуса.
+
+    Параметры:
+        path (str): JSON-файл индекса (загружается, если существует)
+        max_ply (int): Сколько первых полуходов партии индексировать
+        min_games (int): В скольких партиях должна встретиться позиция, чтобы считаться известной
+    """
+
+    def __init__(self, path=None, max_ply=20, min_games=5):
+        self.path = path
+        self.max_ply = max_ply
+        self.min_games = min_games
+        self.positions = {}                            # Zobrist-хеш -> [число партий, число оценок, сумма оценок]
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def add_game(self, game, game_scores=None):
+        """Добавляет дебют партии; game_scores - оценки в формате analyze_games_with_engine (необязательно)"""
+        board = game.board()
+        seen = set()
+        for ply, move in enumerate(game.mainline_moves(), start=1):
+            if ply > self.max_ply:
+                break
+            board.push(move)
+            key = chess.polyglot.zobrist_hash(board)
+            if key in seen:
                 continue
+            seen.add(key)
+            entry = self.positions.setdefault(key, [0, 0, 0.0])
+            entry[0] += 1
+            if game_scores and ply < len(game_scores):
+                entry[1] += 1
+                entry[2] += game_scores[ply]
+
+    def add_games(self, games, all_games_scores=None):
+        """Добавляет дебюты партий (и их оценки, если заданы)"""
+        all_games_scores = all_games_scores if all_games_scores is not None else [None] * len(games)
+        for game, game_scores in zip(games, all_games_scores):
+            self.add_game(game, game_scores)
+
+    def lookup(self, board):
+        """
+        Возвращает (известна ли позиция, средняя оценка в пешках или None, если оценок нет)
+        """
+        entry = self.positions.get(chess.polyglot.zobrist_hash(board))
+        if entry is None or entry[0] < self.min_games:
+            return False, None
+        return True, (round(entry[2] / entry[1], 2) if entry[1] else None)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def save(self, path=None):
+        """Сохраняет индекс в JSON"""
+        path = path or self.path
+        data = {
+            "max_ply": self.max_ply,
+            "min_games": self.min_games,
+            "positions": [[key, *entry] for key, entry in self.positions.items()]
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        self.max_ply = data["max_ply"]
+        self.min_games = data["min_games"]
+        self.positions = {key: [games, scored, total] for key, games, scored, total in data["positions"]}
+
+class PositionResolver:
+    """
+    Оценивает позиции без поиска движком, где оценка уже известна. Проверки (по порядку):
+        terminal - мат или пат
+        syzygy   - эндшпильные таблицы Syzygy: выигрыш ±10 пешек (как мат), ничья (в т.ч. по правилу 50 ходов) - 0
+        index    - позиция из OpeningIndex с оценками корпуса
+        book     - ход из книги Polyglot (или позиция OpeningIndex без оценок): теория, ход без потерь,
+                   оценка равна оценке предыдущей позиции. Последнюю позицию серии книжных ходов analyze_game
+                   все равно оценивает движком и переносит эту оценку на всю серию, иначе первому ходу
+                   после выхода из книги досталось бы все изменение оценки за дебют
 
-        return games
+    Параметры:
+        book_path (str): Путь к книге Polyglot (.bin)
+        syzygy_path (str): Каталог(и) с таблицами Syzygy (несколько - через os.pathsep)
+        opening_index (OpeningIndex или str): Индекс дебютов корпуса или путь к его JSON-файлу
+        syzygy_max_pieces (int): Максимальное число фигур для обращения к таблицам
+    """
 
-    except Exception as e:
-        print(f"Ошибка при получении партий: {e}")
+    sources = ("terminal", "syzygy", "index", "book")
+
+    def __init__(self, book_path=None, syzygy_path=None, opening_index=None, syzygy_max_pieces=7):
+        self.book = chess.polyglot.open_reader(book_path) if book_path else None
+        self.tablebase = None
+        if syzygy_path:
+            self.tablebase = chess.syzygy.Tablebase()
+            for directory in syzygy_path.split(os.pathsep):
+                self.tablebase.add_directory(directory)
+        if isinstance(opening_index, str):
+            opening_index = OpeningIndex(opening_index)
+        self.opening_index = opening_index
+        self.syzygy_max_pieces = syzygy_max_pieces
+        self.hits = {source: 0 for source in self.sources}
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, board, previous_score):
+        """
+        Оценка позиции после последнего хода board (в пешках с точки зрения белых) или None, если нужен движок
+
+        Параметры:
+            board (chess.Board): Позиция после хода (ход - последний в board.move_stack)
+            previous_score (float): Оценка позиции до хода
+        """
+        return self.resolve_source(board, previous_score)[1]
+
+    def resolve_source(self, board, previous_score):
+        """Как resolve, но возвращает (источник из sources или None, оценка или None)"""
+        source, score = self._resolve(board, previous_score)
+        with self._lock:
+            if source is None:
+                self.misses += 1
+            else:
+                self.hits[source] += 1
+        return source, score
+
+    def book_exit(self):
+        """Учитывает, что позицию выхода из книги пришлось оценить движком (попадание книги становится промахом)"""
+        with self._lock:
+            self.hits["book"] -= 1
+            self.misses += 1
+
+    def _resolve(self, board, previous_score):
+        score = terminal_pawns(board)
+        if score is not None:
+            return "terminal", score
+
+        if self.tablebase is not None and not board.castling_rights and chess.popcount(board.occupied) <= self.syzygy_max_pieces:
+            try:
+                with self._lock:
+                    wdl = self.tablebase.probe_wdl(board)
+            except (KeyError, ValueError):
+                wdl = None
+            if wdl is not None:
+                if board.turn == chess.BLACK:
+                    wdl = -wdl
+                return "syzygy", 10.0 if wdl == 2 else -10.0 if wdl == -2 else 0.0
+
+        in_book = False
+        if self.opening_index is not None:
+            in_book, score = self.opening_index.lookup(board)
+            if score is not None:
+                return "index", score
+
+        if not in_book and self.book is not None and board.move_stack:
+            move = board.pop()
+            try:
+                in_book = any(entry.move == move for entry in self.book.find_all(board))
+            finally:
+                board.push(move)
+
+        if in_book:
+            return "book", previous_score
+        return None, None
+
+    def stats(self):
+        """Число разрешенных позиций по источникам, промахов и доля попаданий"""
+        hits = sum(self.hits.values())
+        total = hits + self.misses
+        return dict(self.hits, hits=hits, misses=self.misses, hit_rate=hits / total if total else 0.0)
+
+    def close(self):
+        if self.book is not None:
+            self.book.close()
+        if self.tablebase is not None:
+            self.tablebase.close()
+
+def emit_engine_search(info, seconds):
+    """Отправляет событие engine_search с узлами, скоростью и фактической глубиной поиска"""
+    if _metrics_hooks:
+        emit_metric("engine_search", seconds=seconds, nodes=info.get("nodes"), nps=info.get("nps"), depth=info.get("depth"))
+
+def pgn_eval_to_pawns(node, board):
+    """
+    Возвращает оценку позиции после хода node из комментария [%eval ...] в пешках (как в analyze_games_with_engine)
+    или None, если оценки нет. board - позиция после хода.
+    """
+    score = node.eval()
+    if score is not None:
+        return score_to_pawns(score)
+    return terminal_pawns(board)
+
+def terminal_pawns(board):
+    """Оценка конечной позиции (мат или пат) в пешках или None, если позиция не конечная"""
+    # После мата и пата Lichess не ставит [%eval], но оценка известна и без движка
+    if board.is_checkmate():
+        return score_to_pawns(chess.engine.PovScore(chess.engine.Mate(0), board.turn))
+    if board.is_stalemate():
+        return 0.0
+    return None
+
+def scores_from_pgn_evals(game):
+    """
+    Собирает оценки партии из комментариев [%eval ...] (экспорт Lichess с evals=True, дампы Lichess).
+
+    Возвращает:
+        list: Оценки в формате analyze_games_with_engine или None, если хотя бы у одного хода нет оценки
+    """
+    board = game.board()
+    game_scores = [0.3]  # Начальная оценка
+
+    for move, score in iter_mainline_evals(game, with_evals=True):
+        board.push(move)
+        if score is None:
+            score = terminal_pawns(board)
+        if score is None:
+            return None
+        game_scores.append(score)
+
+    return game_scores
+
+def analyze_game(engine, game, depth=20, cache=None, use_pgn_evals=False, resolver=None):
+    """
+    Анализирует одну партию уже запущенным движком.
+
+    Параметры:
+        engine (chess.engine.SimpleEngine или EngineSession): Запущенный движок
+        game (chess.pgn.Game или CompactGame): Партия
+        depth (int): Глубина анализа движка
+        cache (EvalCache): Кеш оценок позиций (None - без кеша)
+        use_pgn_evals (bool): Брать оценки из комментариев [%eval ...], движок - только для ходов без них
+        resolver (PositionResolver): Книга дебютов и таблицы Syzygy, проверяемые до поиска (None - не проверять)
+
+    Возвращает:
+        list: Оценки позиции после каждого хода (первый элемент - начальная оценка 0.3)
+    """
+    board = game.board()
+    game_scores = [0.3]  # Начальная оценка
+    game_started = time.perf_counter()
+    if isinstance(engine, EngineSession):
+        engine.begin_game(game)
+
+    def search(position):
+        if cache is not None:
+            score = cache.get(position, depth)
+            if score is not None:
+                return score
+
+        started = time.perf_counter()
+        info = engine.analyse(position, chess.engine.Limit(depth=depth))
+        emit_engine_search(info, time.perf_counter() - started)
+        score = score_to_pawns(info["score"])
+
+        if cache is not None:
+            cache.put(position, score, info.get("depth", depth))
+        return score
+
+    # Серия книжных позиций: индекс первой в game_scores и последняя позиция серии
+    book_start = None
+    book_board = None
+
+    def close_book():
+        # Оценка выхода из книги переносится на всю серию (и на начальную позицию, если серия с первого хода),
+        # так что книжные ходы остаются без потерь, а первый ход вне книги сравнивается с настоящей оценкой
+        exit_score = search(book_board)
+        resolver.book_exit()
+        for index in range(0 if book_start == 1 else book_start, len(game_scores)):
+            game_scores[index] = exit_score
+
+    for move, pgn_score in iter_mainline_evals(game, with_evals=use_pgn_evals):
+        board.push(move)
+
+        if use_pgn_evals:
+            score = pgn_score if pgn_score is not None else terminal_pawns(board)
+            if score is not None:
+                if book_start is not None:
+                    close_book()
+                    book_start = None
+                game_scores.append(score)
+                continue
+
+        if resolver is not None:
+            source, score = resolver.resolve_source(board, game_scores[-1])
+            if source == "book":
+                if book_start is None:
+                    book_start = len(game_scores)
+                book_board = board.copy()
+                game_scores.append(score)
+                continue
+            if book_start is not None:
+                close_book()
+                book_start = None
+            if score is not None:
+                game_scores.append(score)
+                continue
+
+        game_scores.append(search(board))
+
+    if book_start is not None:
+        close_book()
+
+    if _metrics_hooks:
+        seconds = time.perf_counter() - game_started
+        emit_metric("stage", stage="engine_search", seconds=seconds)
+        emit_metric("game", seconds=seconds, plies=len(game_scores) - 1)
+
+    return game_scores
+
+def close_engine(engine):
+    """Останавливает движок, даже если он уже не отвечает"""
+    try:
+        engine.quit()
+    except Exception:
+        engine.close()
+
+class EngineSession:
+    """
+    Долгоживущий процесс движка с заданными опциями UCI.
+
+    Сессия переживает вызовы analyze_games_with_engine и разных игроков, поэтому процесс не запускается заново
+    и хеш-таблица движка остается теплой. Внутри партии ucinewgame не отправляется никогда, между партиями -
+    по политике new_game:
+        'game'   - перед каждой партией (оценки партии не зависят от порядка анализа)
+        'player' - когда меняется анализируемый игрок (метка player из metrics_labels): партии одного игрока
+                   с общим дебютным репертуаром переиспользуют хеш
+        'never'  - только после запуска движка
+
+    Параметры:
+        engine_path (str): Путь к исполняемому файлу шахматного движка
+        threads (int): Опция Threads (None - значение движка по умолчанию)
+        hash_mb (int): Опция Hash в МБ (None - значение движка по умолчанию)
+        options (dict): Другие опции UCI
+        timeout (float): Время ожидания запуска движка и ответов на служебные команды, с
+        analysis_timeout (float): Максимальное время одного поиска, с; зависший движок останавливается
+                                  (None - без ограничения)
+        new_game (str): Политика отправки ucinewgame: 'game', 'player' или 'never'
+    """
+
+    def __init__(self, engine_path='/usr/games/stockfish', threads=None, hash_mb=None, options=None, timeout=10.0, analysis_timeout=None, new_game="player"):
+        if new_game not in ("game", "player", "never"):
+            raise ValueError(f"Неизвестная политика new_game: {new_game}")
+        self.engine_path = engine_path
+        self.options = dict(options or {})
+        if threads is not None:
+            self.options["Threads"] = threads
+        if hash_mb is not None:
+            self.options["Hash"] = hash_mb
+        self.timeout = timeout
+        self.analysis_timeout = analysis_timeout
+        self.new_game = new_game
+        self.restarts = 0
+        self.new_games = 0
+        self.searches = 0
+        self.engine = None
+        self._game_key = None
+        self._sent_game_key = None
+        self._games_begun = 0
+        self.start()
+
+    def start(self):
+        """Запускает процесс движка и выставляет опции"""
+        self.engine = chess.engine.SimpleEngine.popen_uci(self.engine_path, timeout=self.timeout)
+        if self.options:
+            self.engine.configure(self.options)
+        # После запуска python-chess сам отправит ucinewgame перед первым поиском
+        self._sent_game_key = None
+        self._fresh = True
+
+    def restart(self):
+        """Перезапускает движок (после падения, зависания или неудачной проверки)"""
+        if self.engine is not None:
+            close_engine(self.engine)
+        self.restarts += 1
+        emit_metric("engine_restart", engine=self.engine_path)
+        self.start()
+
+    def healthy(self):
+        """Проверка isready/readyok: движок жив и отвечает"""
+        try:
+            self.engine.ping()
+            return True
+        except Exception:
+            return False
+
+    def ensure_healthy(self):
+        """Перезапускает движок, если он не отвечает"""
+        if not self.healthy():
+            self.restart()
+
+    def begin_game(self, game=None):
+        """Сообщает о начале анализа новой партии; решение об ucinewgame принимается по политике new_game"""
+        if self.new_game == "game":
+            # Ключ - порядковый номер вызова: у партий не с Lichess нет идентификатора, а id() объекта
+            # освобожденной партии может достаться следующей
+            self._games_begun += 1
+            self._game_key = ("game", self._games_begun)
+        elif self.new_game == "player":
+            self._game_key = ("player", _metrics_labels.get().get("player"))
+        else:
+            self._game_key = None
+
+    def analyse(self, board, limit, **kwargs):
+        """
+        Анализ позиции (как chess.engine.SimpleEngine.analyse). Если поиск дольше analysis_timeout,
+        движок закрывается и возникает chess.engine.EngineTerminatedError
+        """
+        if self._fresh or self._game_key != self._sent_game_key:
+            self.new_games += 1
+            self._sent_game_key = self._game_key
+            self._fresh = False
+        self.searches += 1
+
+        if self.analysis_timeout is None:
+            return self.engine.analyse(board, limit, game=self._game_key, **kwargs)
+
+        watchdog = threading.Timer(self.analysis_timeout, self.engine.close)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            return self.engine.analyse(board, limit, game=self._game_key, **kwargs)
+        finally:
+            watchdog.cancel()
+
+    def close(self):
+        if self.engine is not None:
+            close_engine(self.engine)
+            self.engine = None
+
+class EnginePool:
+    """
+    Набор долгоживущих сессий движка (EngineSession), общий для многих вызовов и игроков.
+
+    Сессии запускаются по требованию (не больше size), после использования возвращаются в пул
+    и перед повторной выдачей проверяются isready; упавшие движки перезапускаются.
+
+    Пример:
+        with EnginePool('/usr/games/stockfish', size=4, hash_mb=256) as engines:
+            for username in usernames:
+                df = analyze_player_performance(username, engines=engines, token=token)
+
+    Параметры:
+        engine_path (str): Путь к движку
+        size (int): Максимальное число процессов движка
+        Остальные параметры - как у EngineSession
+    """
+
+    def __init__(self, engine_path='/usr/games/stockfish', size=1, threads=None, hash_mb=None, options=None, timeout=10.0, analysis_timeout=None, new_game="player"):
+        self.engine_path = engine_path
+        self.size = max(1, size)
+        self.session_options = dict(
+            threads=threads, hash_mb=hash_mb, options=options, timeout=timeout,
+            analysis_timeout=analysis_timeout, new_game=new_game
+        )
+        self._idle = queue.LifoQueue()                 # Последней возвращенной сессии нужнее всего теплый хеш
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self):
+        """Выдает сессию движка на время блока with"""
+        session = None
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                start_new = len(self._sessions) < self.size
+                if start_new:
+                    self._sessions.append(None)        # Резервируем место, сам запуск - без блокировки
+            if start_new:
+                try:
+                    session = EngineSession(self.engine_path, **self.session_options)
+                except Exception:
+                    with self._lock:
+                        self._sessions.remove(None)
+                    raise
+                with self._lock:
+                    self._sessions[self._sessions.index(None)] = session
+            else:
+                session = self._idle.get()
+
+        try:
+            if session.searches:
+                session.ensure_healthy()
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def stats(self):
+        """Число процессов, перезапусков, ucinewgame и поисков по всем сессиям"""
+        sessions = [session for session in self._sessions if session is not None]
+        return {
+            "engines": len(sessions),
+            "restarts": sum(session.restarts for session in sessions),
+            "new_games": sum(session.new_games for session in sessions),
+            "searches": sum(session.searches for session in sessions)
+        }
+
+    def close(self):
+        """Останавливает все движки пула"""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            if session is not None:
+                session.close()
+        while not self._idle.empty():
+            self._idle.get_nowait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+@contextlib.contextmanager
+def engine_pool(engines=None, engine_path='/usr/games/stockfish', size=1, threads=None, hash_mb=None):
+    """
+    Пул движков для одного вызова: переданный пул engines (не закрывается) или временный,
+    который останавливается после блока with
+    """
+    if engines is not None:
+        yield engines
+        return
+    pool = EnginePool(engine_path, size=size, threads=threads, hash_mb=hash_mb)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+def analyze_game_with_restarts(engine, game, depth=20, cache=None, engine_path='/usr/games/stockfish', threads=None, hash_mb=None, max_restarts=3, use_pgn_evals=False, resolver=None):
+    """
+    Анализирует партию, перезапуская движок, если он упал во время анализа.
+
+    Возвращает:
+        tuple: (работающий движок, список оценок партии или [] при ошибке)
+    """
+    restarts = 0
+    while True:
+        try:
+            return engine, analyze_game(engine, game, depth=depth, cache=cache, use_pgn_evals=use_pgn_evals, resolver=resolver)
+        except (chess.engine.EngineTerminatedError, chess.engine.EngineError) as e:
+            # Движок упал - перезапускаем его и анализируем партию заново
+            if isinstance(engine, EngineSession):
+                engine.restart()
+            else:
+                try:
+                    engine.close()
+                except Exception:
+                    pass
+                engine = open_engine(engine_path, threads=threads, hash_mb=hash_mb)
+            restarts += 1
+            if restarts > max_restarts:
+                print(f"\nОшибка при анализе партии: {e}")
+                return engine, []
+        except Exception as e:
+            print(f"\nОшибка при анализе партии: {e}")
+            return engine, []
+
+def analyze_games_with_engine(games, engine_path='/usr/games/stockfish', depth=20, n_engines=1, threads=None, hash_mb=None, max_restarts=3, cache=None, use_pgn_evals=False, engines=None, resolver=None):
+    """
+    Анализирует партии с помощью шахматного движка и возвращает оценки позиций после каждого хода.
+
+    Параметры:
+        games (list): Список объектов chess.pgn.Game или CompactGame
+        engine_path (str): Путь к исполняемому файлу шахматного движка (например, stockfish)
+        depth (int): Глубина анализа движка (количество полуходов)
+        n_engines (int): Число параллельно работающих процессов движка
+        threads (int): Опция Threads для каждого процесса движка
+        hash_mb (int): Опция Hash (МБ) для каждого процесса движка
+        max_restarts (int): Сколько раз можно перезапустить упавший движок на одной партии
+        cache (EvalCache): Кеш оценок позиций (None - без кеша)
+        use_pgn_evals (bool): Брать оценки из комментариев [%eval ...] в PGN; движок запускается только
+                              для партий и ходов без них
+        engines (EnginePool): Долгоживущие движки (тогда параллельно работают engines.size движков, а engine_path,
+                              threads и hash_mb не используются); None - движки запускаются на время вызова
+        resolver (PositionResolver): Книга дебютов и таблицы Syzygy: разрешенные ими позиции движку не отправляются
+
+    Возвращает:
+        list: Список списков с оценками для каждой партии (в исходном порядке партий)
+    """
+    games = list(games)
+    all_games_scores = [None] * len(games)
+
+    # Очередь заданий общая для всех движков: освободившийся движок сразу берет следующую партию
+    tasks = queue.Queue()
+    for index, game in enumerate(games):
+        if use_pgn_evals:
+            # Полностью размеченные партии вообще не отправляем движку
+            game_scores = scores_from_pgn_evals(game)
+            if game_scores is not None:
+                all_games_scores[index] = game_scores
+                continue
+        tasks.put((index, game))
+
+    if use_pgn_evals:
+        print(f"Оценки из PGN: {len(games) - tasks.qsize()} из {len(games)} партий")
+
+    progress = tqdm(total=len(games), initial=len(games) - tasks.qsize(), desc="Анализ партий", unit="game")
+    progress_lock = threading.Lock()
+
+    def worker(pool):
+        with pool.session() as engine:
+            while True:
+                try:
+                    index, game = tasks.get_nowait()
+                except queue.Empty:
+                    break
+
+                engine, all_games_scores[index] = analyze_game_with_restarts(
+                    engine, game, depth=depth, cache=cache, engine_path=engine_path,
+                    threads=threads, hash_mb=hash_mb, max_restarts=max_restarts, use_pgn_evals=use_pgn_evals, resolver=resolver
+                )
+
+                with progress_lock:
+                    progress.update(1)
+
+    # Движки запускаются, только если остались партии для анализа
+    if engines is not None:
+        n_engines = engines.size
+    n_engines = min(max(1, n_engines), tasks.qsize())
+    if n_engines >= 1:
+        with engine_pool(engines, engine_path, size=n_engines, threads=threads, hash_mb=hash_mb) as pool:
+            if n_engines == 1:
+                worker(pool)
+            else:
+                with ThreadPoolExecutor(max_workers=n_engines) as executor:
+                    # Каждый поток получает копию контекста, чтобы видеть метки метрик вызывающего кода
+                    futures = [executor.submit(contextvars.copy_context().run, worker, pool) for _ in range(n_engines)]
+                    for future in futures:
+                        future.result()
+
+    progress.close()
+
+    if cache is not None:
+        cache.flush()
+        cache_stats = cache.stats()
+        emit_metric("cache", cache="eval", hits=cache_stats["hits"], misses=cache_stats["misses"])
+        print(f"Кеш оценок: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']} ({cache_stats['hit_rate']:.1%})")
+
+    if resolver is not None:
+        resolver_stats = resolver.stats()
+        emit_metric("cache", cache="resolver", hits=resolver_stats["hits"], misses=resolver_stats["misses"])
+        print(
+            f"Без движка: {resolver_stats['hits']} из {resolver_stats['hits'] + resolver_stats['misses']} позиций ({resolver_stats['hit_rate']:.1%}); "
+            + ", ".join(f"{source} {resolver_stats[source]}" for source in PositionResolver.sources)
+        )
 
-!which stockfish || find / -name stockfish 2>/dev/null | head -5
+    return all_games_scores
 
-def analyze_games_with_engine(games, engine_path='/usr/games/stockfish', depth=20):
+def analyze_games_adaptive(games, engine_path='/usr/games/stockfish', depth=20, shallow_depth=8, shallow_nodes=None, margin=30, threads=None, hash_mb=None, cache=None, verify=False, engines=None, max_restarts=3):
     """
-    Анализирует партии с помощью шахматного движка и возвращает оценки позиций после каждого хода.
+    Двухэтапный анализ партий: быстрый неглубокий проход по всем позициям,
+    затем полная глубина только там, где от оценки зависит классификация хода.
+
+    Позиция перепроверяется на глубине depth, если потери хода, который в нее ведет или из нее делается,
+    лежат ближе чем margin сантипешек к одному из порогов (50, 100, 200, 300), используемых
+    в analyze_player_performance. Ходы, где оценка до и после уже ограничена ±10 пешками
+    с одним знаком, не перепроверяются.
 
     Параметры:
-        games (list): Список объектов chess.pgn.Game
-        engine_path (str): Путь к исполняемому файлу шахматного движка (например, stockfish)
-        depth (int): Глубина анализа движка (количество полуходов)
+        games (list): Список объектов chess.pgn.Game или CompactGame
+        engine_path (str): Путь к исполняемому файлу шахматного движка
+        depth (int): Полная глубина анализа
+        shallow_depth (int): Глубина быстрого прохода
+        shallow_nodes (int): Лимит узлов быстрого прохода (если задан, используется вместо shallow_depth)
+        margin (float): Окрестность порогов классификации в сантипешках
+        threads (int): Опция Threads движка
+        hash_mb (int): Опция Hash (МБ) движка
+        cache (EvalCache): Кеш оценок позиций полной глубины (None - без кеша)
+        verify (bool): Дополнительно проанализировать все позиции на полной глубине и посчитать отклонение метрик
+        engines (EnginePool): Долгоживущие движки (None - движки запускаются на время вызова)
+        max_restarts (int): Сколько раз можно перезапустить упавший движок на одной партии
 
     Возвращает:
-        list: Список списков с оценками для каждой партии
+        tuple: (список списков с оценками, как в analyze_games_with_engine; словарь с отчетом)
     """
-    # Инициализируем движок
-    engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+    thresholds = (50, 100, 200, 300)
+    if shallow_nodes is not None:
+        shallow_limit = chess.engine.Limit(nodes=shallow_nodes)
+    else:
+        shallow_limit = chess.engine.Limit(depth=shallow_depth)
+    deep_limit = chess.engine.Limit(depth=depth)
+
+    resources = contextlib.ExitStack()
+    pool = resources.enter_context(engine_pool(engines, engine_path, threads=threads, hash_mb=hash_mb))
+    engine = resources.enter_context(pool.session())
 
     all_games_scores = []
+    total_plies = 0
+    deepened_plies = 0
+    shallow_time = 0.0
+    deep_time = 0.0
+
+    def analyze_one(game):
+        engine.begin_game(game)
+
+        # 1. Быстрый проход по всем позициям
+        board = game.board()
+        boards = [None]
+        game_scores = [0.3]  # Начальная оценка
+
+        started = time.perf_counter()
+        for move in game.mainline_moves():
+            board.push(move)
+            boards.append(board.copy())
+            search_started = time.perf_counter()
+            info = engine.analyse(board, shallow_limit)
+            emit_engine_search(info, time.perf_counter() - search_started)
+            game_scores.append(score_to_pawns(info["score"]))
+        game_shallow_time = time.perf_counter() - started
+
+        # 2. Отбираем позиции, где классификация хода может измениться
+        to_deepen = set()
+        game_losses = analyze_player_losses([game_scores])[0]
+        for i, loss in enumerate(game_losses):
+            before, after = game_scores[i], game_scores[i + 1]
+            if abs(before) >= 10 and abs(after) >= 10 and before * after > 0:
+                continue
+            if any(abs(loss - threshold) <= margin for threshold in thresholds):
+                to_deepen.update(j for j in (i, i + 1) if j > 0)
+
+        # 3. Перепроверяем их на полной глубине
+        started = time.perf_counter()
+        for j in sorted(to_deepen):
+            score = cache.get(boards[j], depth) if cache is not None else None
+            if score is None:
+                search_started = time.perf_counter()
+                info = engine.analyse(boards[j], deep_limit)
+                emit_engine_search(info, time.perf_counter() - search_started)
+                score = score_to_pawns(info["score"])
+                if cache is not None:
+                    cache.put(boards[j], score, info.get("depth", depth))
+            game_scores[j] = score
+        game_deep_time = time.perf_counter() - started
+
+        return game_scores, len(boards) - 1, len(to_deepen), game_shallow_time, game_deep_time
 
-    for game in tqdm(games, desc="Анализ партий", unit="game"):
-        try:
-            board = game.board()
-            game_scores = [0.3]  # Начальная оценка
+    try:
+        for game in tqdm(games, desc="Анализ партий", unit="game"):
+            restarts = 0
+            while True:
+                try:
+                    game_scores, plies, deepened, game_shallow_time, game_deep_time = analyze_one(game)
+                except (chess.engine.EngineTerminatedError, chess.engine.EngineError) as e:
+                    # Движок упал - перезапускаем его и анализируем партию заново, как в analyze_game_with_restarts
+                    engine.restart()
+                    restarts += 1
+                    if restarts > max_restarts:
+                        print(f"\nОшибка при анализе партии: {e}")
+                        game_scores = None
+                        break
+                    continue
+                except Exception as e:
+                    print(f"\nОшибка при анализе партии: {e}")
+                    game_scores = None
+                    break
+
+                total_plies += plies
+                deepened_plies += deepened
+                shallow_time += game_shallow_time
+                deep_time += game_deep_time
+                break
+
+            all_games_scores.append(game_scores if game_scores is not None else [])
+    finally:
+        resources.close()
+        if cache is not None:
+            cache.flush()
+
+    # Время полного анализа оцениваем по средней скорости перепроверки на полной глубине
+    full_time_estimate = deep_time / deepened_plies * total_plies if deepened_plies else None
+    report = {
+        "plies": total_plies,
+        "deepened_plies": deepened_plies,
+        "deepened_share": deepened_plies / total_plies if total_plies else 0.0,
+        "shallow_time": shallow_time,
+        "deep_time": deep_time,
+        "full_time_estimate": full_time_estimate,
+        "time_saved_estimate": full_time_estimate - shallow_time - deep_time if full_time_estimate is not None else None
+    }
+
+    if verify:
+        # Эталон: обычный анализ всех позиций на полной глубине
+        started = time.perf_counter()
+        full_scores = analyze_games_with_engine(games, engine_path, depth=depth, threads=threads, hash_mb=hash_mb, engines=engines)
+        report["full_time"] = time.perf_counter() - started
+        report["time_saved"] = report["full_time"] - shallow_time - deep_time
+        report["drift"] = metrics_drift(all_games_scores, full_scores)
+
+    print(
+        f"Перепроверено на полной глубине {deepened_plies} из {total_plies} позиций ({report['deepened_share']:.1%}), "
+        f"время: {shallow_time:.1f} с (быстрый проход) + {deep_time:.1f} с (полная глубина)"
+    )
+
+    return all_games_scores, report
+
+def analyze_games_scheduled(games, engine_path='/usr/games/stockfish', depth=20, n_engines=1, threads=None, hash_mb=None, cache=None, engines=None, max_restarts=3, segment_size=64):
+    """
+    Анализирует пакет партий, отправляя движку каждую различную позицию пакета ровно один раз.
 
-            for move in game.mainline_moves():
-                board.push(move)
-                info = engine.analyse(board, chess.engine.Limit(depth=depth))
-                score = info["score"].white().score(mate_score=10000)  # Увеличим mate_score для надежности
-
-                if score is not None:
-                    # Правильное масштабирование оценки (делим на 100, так как 1 пешка = 100 единиц)
-                    normalized_score = score / 100
-                    # Ограничиваем диапазон для избежания экстремальных значений
-                    normalized_score = min(max(normalized_score, -10), 10)  # ±10 пешек
-                else:
-                    normalized_score = 0.0
+    По партиям строится дерево общих префиксов ходов; позиции (ключ - Zobrist-хеш, как в EvalCache, поэтому
+    учитываются и перестановки ходов) ищутся в порядке обхода дерева в глубину, так что соседние поиски идут
+    по одной линии и переиспользуют хеш движка. Порядок делится на непрерывные отрезки по segment_size позиций,
+    которые разбирают параллельные движки. Оценки затем раздаются всем партиям, где встретилась позиция.
+
+    Параметры:
+        games (list): Список объектов chess.pgn.Game или CompactGame
+        engine_path, depth, n_engines, threads, hash_mb, cache, engines: Как в analyze_games_with_engine
+        max_restarts (int): Сколько раз перезапускать упавший движок на одной позиции
+        segment_size (int): Число позиций в одном задании движка
 
-                game_scores.append(normalized_score)
+    Возвращает:
+        tuple: (список списков с оценками, как в analyze_games_with_engine; словарь с отчетом)
+    """
+    games = list(games)
+
+    # 1. Дерево префиксов ходов: узел - [дети по ходу, ключ позиции]
+    roots = {}
+    games_moves = []
+    games_keys = []
+    first_seen = {}                                    # Ключ позиции -> (номер партии, полуход), где она встретилась впервые
+    for index, game in enumerate(games):
+        board = game.board()
+        moves = list(game.mainline_moves())
+        node = roots.setdefault(chess.polyglot.zobrist_hash(board), [{}, None])
+        keys = []
+        for ply, move in enumerate(moves, start=1):
+            board.push(move)
+            child = node[0].get(move)
+            if child is None:
+                child = node[0][move] = [{}, chess.polyglot.zobrist_hash(board)]
+            node = child
+            keys.append(node[1])
+            first_seen.setdefault(node[1], (index, ply))
+        games_moves.append(moves)
+        games_keys.append(keys)
+
+    # 2. Порядок поиска - обход дерева в глубину, каждая позиция один раз
+    order = []
+    visited = set()
+    stack = list(reversed(list(roots.values())))
+    while stack:
+        children, key = stack.pop()
+        if key is not None and key not in visited:
+            visited.add(key)
+            order.append(key)
+        stack.extend(reversed(list(children.values())))
+
+    naive_searches = sum(len(keys) for keys in games_keys)
+    scores = {}
+    failed = set()
+    counters = {"searches": 0, "cache_hits": 0}
+    counters_lock = threading.Lock()
+    limit = chess.engine.Limit(depth=depth)
+
+    segments = queue.Queue()
+    for start in range(0, len(order), segment_size):
+        segments.put(order[start:start + segment_size])
+
+    progress = tqdm(total=len(order), desc="Анализ позиций", unit="pos")
+
+    def worker(pool):
+        with pool.session() as engine:
+            engine.begin_game()
+            while True:
+                try:
+                    segment = segments.get_nowait()
+                except queue.Empty:
+                    break
+
+                board = None
+                position = None
+                for key in segment:
+                    index, ply = first_seen[key]
+                    # Следующая позиция отрезка чаще всего - продолжение той же линии: достаточно одного хода
+                    if board is not None and position == (index, ply - 1):
+                        board.push(games_moves[index][ply - 1])
+                    else:
+                        board = games[index].board()
+                        for move in games_moves[index][:ply]:
+                            board.push(move)
+                    position = (index, ply)
+
+                    score = cache.get(board, depth) if cache is not None else None
+                    if score is not None:
+                        scores[key] = score
+                        with counters_lock:
+                            counters["cache_hits"] += 1
+                        continue
+
+                    for attempt in range(max_restarts + 1):
+                        try:
+                            started = time.perf_counter()
+                            info = engine.analyse(board, limit)
+                            emit_engine_search(info, time.perf_counter() - started)
+                            break
+                        except (chess.engine.EngineTerminatedError, chess.engine.EngineError) as e:
+                            engine.restart()
+                            info = None
+                            error = e
+                    if info is None:
+                        print(f"\nОшибка при анализе позиции: {error}")
+                        failed.add(key)
+                        continue
+
+                    scores[key] = score_to_pawns(info["score"])
+                    with counters_lock:
+                        counters["searches"] += 1
+                    if cache is not None:
+                        cache.put(board, scores[key], info.get("depth", depth))
+
+                with counters_lock:
+                    progress.update(len(segment))
+
+    started = time.perf_counter()
+    if engines is not None:
+        n_engines = engines.size
+    n_engines = min(max(1, n_engines), segments.qsize())
+    if n_engines >= 1:
+        with engine_pool(engines, engine_path, size=n_engines, threads=threads, hash_mb=hash_mb) as pool:
+            if n_engines == 1:
+                worker(pool)
+            else:
+                with ThreadPoolExecutor(max_workers=n_engines) as executor:
+                    futures = [executor.submit(contextvars.copy_context().run, worker, pool) for _ in range(n_engines)]
+                    for future in futures:
+                        future.result()
+    progress.close()
+    emit_metric("stage", stage="engine_search", seconds=time.perf_counter() - started)
 
-            all_games_scores.append(game_scores)
+    if cache is not None:
+        cache.flush()
 
-        except Exception as e:
-            print(f"\nОшибка при анализе партии: {e}")
+    # 3. Раздаем оценки партиям (партия с неразобранной позицией - пустой список, как при ошибке анализа)
+    all_games_scores = []
+    for keys in games_keys:
+        if any(key in failed for key in keys):
             all_games_scores.append([])
-            continue
+        else:
+            all_games_scores.append([0.3] + [scores[key] for key in keys])
+
+    report = {
+        "naive_searches": naive_searches,
+        "positions": len(order),
+        "searches": counters["searches"],
+        "cache_hits": counters["cache_hits"],
+        "removed": naive_searches - counters["searches"],
+        "removed_share": (naive_searches - counters["searches"]) / naive_searches if naive_searches else 0.0
+    }
+    emit_metric("schedule", **{key: report[key] for key in ("naive_searches", "positions", "searches", "removed")})
+    print(
+        f"Поисков движка: {report['searches']} вместо {naive_searches} "
+        f"(убрано {report['removed']}, {report['removed_share']:.1%}; различных позиций {len(order)})"
+    )
+    return all_games_scores, report
+
+def metrics_drift(all_games_scores, reference_scores):
+    """
+    Сравнивает метрики, посчитанные по двум наборам оценок одних и тех же партий (за обе стороны).
 
-    engine.quit()
-    return all_games_scores
+    Возвращает:
+        dict: Для каждой метрики - среднее абсолютное отклонение по партиям и доля партий, где она изменилась
+    """
+    # Берем только партии, проанализированные в обоих наборах
+    pairs = [
+        (scores, reference) for scores, reference in zip(all_games_scores, reference_scores)
+        if scores and reference and len(scores) == len(reference)
+    ]
+    if not pairs:
+        return {}
+
+    scores, offsets = flatten_scores([scores for scores, _ in pairs])
+    reference, _ = flatten_scores([reference for _, reference in pairs])
+    opponents = [""] * len(pairs)
+
+    drift = {}
+    for is_white in (True, False):
+        player_is_white = [is_white] * len(pairs)
+        df = calculate_metrics_from_flat(scores, offsets, player_is_white, opponents)
+        df_reference = calculate_metrics_from_flat(reference, offsets, player_is_white, opponents)
+        for column in ("Accuracy", "AvgLoss", "Blunders", "Mistakes", "Inaccuracies"):
+            difference = (df[column] - df_reference[column]).abs()
+            drift.setdefault(column, []).append(difference)
+
+    return {
+        column: {
+            "mean_abs_diff": float(pd.concat(values).mean()),
+            "changed_share": float((pd.concat(values) > 0).mean())
+        }
+        for column, values in drift.items()
+    }
 
 def analyze_player_losses(all_games_scores):
     """
@@ -175,7 +2179,334 @@ def calculate_accuracy(win_diff):
     """Вычисляет Accuracy% из разницы Win%"""
     return 103.1668 * math.exp(-0.04354 * win_diff) - 3.1669
 
-def analyze_player_performance(username, engine_path='/usr/games/stockfish', token='your_token',  end_date=None, days=365, perf_type="blitz", depth=20):
+def calculate_game_metrics(game, game_scores, game_losses, username):
+    """
+    Вычисляет метрики игрока в одной партии
+
+    Параметры:
+        game (chess.pgn.Game или CompactGame): Партия
+        game_scores (list): Оценки позиций партии (результат analyze_games_with_engine)
+        game_losses (list): Потери в сантипешках (результат analyze_player_losses)
+        username (str): Ник игрока
+
+    Возвращает:
+        dict: Строка с метриками партии или None, если партию не удалось проанализировать
+    """
+    if not game_scores or not game_losses:
+        return None
+
+    # Определяем цвет игрока
+    player_is_white = (game.headers["White"] == username)
+    opponent = game.headers["Black"] if player_is_white else game.headers["White"]
+
+    # Инициализируем метрики для партии
+    total_accuracy = 0
+    total_moves = 0
+    blunders = 0
+    mistakes = 0
+    inaccuracies = 0
+    total_loss = 0
+
+    # Проходим по всем ходам
+    for i in range(len(game_losses)):
+        if player_is_white:
+            # Для белых анализируем нечетные ходы (1, 3, 5...)
+            if i % 2 == 0:
+                # Конвертируем оценки в сантипешки
+                cp_before = game_scores[i] * 100
+                cp_after = game_scores[i+1] * 100
+
+                # Вычисляем Win%
+                win_before = calculate_win_percent(cp_before)
+                win_after = calculate_win_percent(cp_after)
+                win_diff = win_before - win_after
+
+                # Вычисляем Accuracy
+                accuracy = calculate_accuracy(abs(win_diff))
+                total_accuracy += accuracy
+                total_moves += 1
+
+                # Анализируем потери
+                loss = game_losses[i]
+                total_loss += loss
+
+                if loss > 300:
+                    blunders += 1
+                elif loss > 100:
+                    mistakes += 1
+                elif loss > 50:
+                    inaccuracies += 1
+        else:
+            # Для черных анализируем четные ходы (2, 4, 6...)
+            if i % 2 == 1:
+                # Конвертируем оценки в сантипешки
+                cp_before = game_scores[i] * 100
+                cp_after = game_scores[i+1] * 100
+
+                # Вычисляем Win%
+                win_before = calculate_win_percent(-cp_before)  # Инвертируем для черных
+                win_after = calculate_win_percent(-cp_after)
+                win_diff = win_before - win_after
+
+                # Вычисляем Accuracy
+                accuracy = calculate_accuracy(abs(win_diff))
+                total_accuracy += accuracy
+                total_moves += 1
+
+                # Анализируем потери
+                loss = game_losses[i]
+                total_loss += loss
+
+                if loss > 200:
+                    blunders += 1
+                elif loss > 100:
+                    mistakes += 1
+                elif loss > 50:
+                    inaccuracies += 1
+
+    # Вычисляем средние значения
+    if total_moves > 0:
+        avg_accuracy = total_accuracy / total_moves
+        avg_loss = total_loss / total_moves
+    else:
+        avg_accuracy = 0
+        avg_loss = 0
+
+    # Возвращаем результат партии
+    return {
+        "Opponent": opponent,
+        "Color": "White" if player_is_white else "Black",
+        "Accuracy": round(avg_accuracy, 1),
+        "AvgLoss": round(avg_loss, 1),
+        "Blunders": blunders,
+        "Mistakes": mistakes,
+        "Inaccuracies": inaccuracies,
+        "TotalMoves": total_moves
+    }
+
+def flatten_scores(all_games_scores):
+    """
+    Склеивает оценки всех партий в один плоский массив.
+
+    Параметры:
+        all_games_scores (list): Список списков с оценками позиций для каждой партии
+
+    Возвращает:
+        tuple: (scores - np.ndarray float64 со всеми оценками подряд,
+                offsets - np.ndarray int64 длины n+1, оценки партии g лежат в scores[offsets[g]:offsets[g+1]])
+    """
+    lengths = np.fromiter((len(game_scores) for game_scores in all_games_scores), dtype=np.int64, count=len(all_games_scores))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    scores = np.fromiter(
+        (score for game_scores in all_games_scores for score in game_scores), dtype=np.float64, count=int(offsets[-1])
+    )
+    return scores, offsets
+
+def calculate_metrics_from_flat(scores, offsets, player_is_white, opponents, blunder_white=300, blunder_black=200, mistake=100, inaccuracy=50):
+    """
+    Векторно вычисляет метрики игрока сразу для всех партий (то же, что calculate_game_metrics, но без цикла по ходам).
+
+    Параметры:
+        scores (np.ndarray): Оценки всех партий подряд в пешках (см. flatten_scores)
+        offsets (np.ndarray): Границы партий в scores, длина n+1
+        player_is_white (array-like): Для каждой партии - играл ли игрок белыми
+        opponents (array-like): Ник соперника в каждой партии
+        blunder_white, blunder_black (float): Порог зевка в сантипешках для белых и черных
+        mistake (float): Порог ошибки в сантипешках
+        inaccuracy (float): Порог неточности в сантипешках
+
+    Возвращает:
+        pd.DataFrame: Те же колонки, что и analyze_player_performance; партии без ходов пропускаются
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    player_is_white = np.asarray(player_is_white, dtype=bool)
+    opponents = np.asarray(opponents, dtype=object)
+    n_games = len(offsets) - 1
+
+    # Ходы игрока в партии g - это позиции offsets[g] + first, first + 2, ... (first = 0 за белых, 1 за черных)
+    lengths = np.diff(offsets)
+    first = np.where(player_is_white, 0, 1)
+    counts = np.maximum(lengths - first, 0) // 2
+    game_of_move = np.repeat(np.arange(n_games), counts)
+    move_starts = np.zeros(n_games, dtype=np.int64)
+    np.cumsum(counts[:-1], out=move_starts[1:])
+    before = np.repeat(offsets[:-1] + first, counts) + 2 * (np.arange(int(counts.sum())) - np.repeat(move_starts, counts))
+    white_move = player_is_white[game_of_move]
+
+    # Потери в сантипешках (как в analyze_player_losses): ухудшение оценки со стороны ходившего
+    sign = np.where(white_move, 1.0, -1.0)
+    delta = scores[before + 1] - scores[before]
+    loss = np.maximum(-sign * delta, 0.0) * 100
+
+    # Win% и Accuracy (как в calculate_win_percent и calculate_accuracy), для черных оценка инвертируется
+    win_before = 50 + 50 * (2 / (1 + np.exp(-0.00368208 * (sign * (scores[before] * 100)))) - 1)
+    win_after = 50 + 50 * (2 / (1 + np.exp(-0.00368208 * (sign * (scores[before + 1] * 100)))) - 1)
+    accuracy = 103.1668 * np.exp(-0.04354 * np.abs(win_before - win_after)) - 3.1669
+
+    blunder = np.where(white_move, loss > blunder_white, loss > blunder_black)
+    mistake_mask = ~blunder & (loss > mistake)
+    inaccuracy_mask = ~blunder & ~mistake_mask & (loss > inaccuracy)
+
+    # bincount суммирует по порядку ходов, поэтому суммы совпадают с поэлементным циклом
+    total_moves = np.bincount(game_of_move, minlength=n_games)
+    total_accuracy = np.bincount(game_of_move, weights=accuracy, minlength=n_games)
+    total_loss = np.bincount(game_of_move, weights=loss, minlength=n_games)
+    blunders = np.bincount(game_of_move, weights=blunder, minlength=n_games).astype(np.int64)
+    mistakes = np.bincount(game_of_move, weights=mistake_mask, minlength=n_games).astype(np.int64)
+    inaccuracies = np.bincount(game_of_move, weights=inaccuracy_mask, minlength=n_games).astype(np.int64)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_accuracy = np.where(total_moves > 0, total_accuracy / total_moves, 0.0)
+        avg_loss = np.where(total_moves > 0, total_loss / total_moves, 0.0)
+
+    # Партии без оценок или без ходов пропускаются, как в analyze_player_performance
+    played = lengths > 1
+
+    return pd.DataFrame({
+        "Opponent": opponents[played],
+        "Color": np.where(player_is_white[played], "White", "Black"),
+        "Accuracy": [round(value, 1) for value in avg_accuracy[played].tolist()],
+        "AvgLoss": [round(value, 1) for value in avg_loss[played].tolist()],
+        "Blunders": blunders[played],
+        "Mistakes": mistakes[played],
+        "Inaccuracies": inaccuracies[played],
+        "TotalMoves": total_moves[played]
+    })
+
+def calculate_metrics_vectorized(games, all_games_scores, username, **thresholds):
+    """
+    Векторно вычисляет метрики игрока по партиям и их оценкам (результат analyze_games_with_engine).
+
+    Параметры:
+        games (list): Список объектов chess.pgn.Game или CompactGame
+        all_games_scores (list): Список списков с оценками позиций для каждой партии
+        username (str): Ник игрока
+        thresholds: Пороги зевка/ошибки/неточности (см. calculate_metrics_from_flat)
+
+    Возвращает:
+        pd.DataFrame: DataFrame с метриками по партиям
+    """
+    with timed_stage("metrics", player=username):
+        scores, offsets = flatten_scores(all_games_scores)
+        player_is_white = [game.headers["White"] == username for game in games]
+        opponents = [
+            game.headers["Black"] if is_white else game.headers["White"]
+            for game, is_white in zip(games, player_is_white)
+        ]
+        return calculate_metrics_from_flat(scores, offsets, player_is_white, opponents, **thresholds)
+
+class ScoreStore:
+    """
+    Компактное колоночное хранилище оценок позиций всех партий.
+
+    Хранится в каталоге из трех файлов:
+        scores.npy  - все оценки подряд в сантипешках (int16, оценки ограничены ±1000)
+        offsets.npy - границы партий (int64, длина n+1)
+        games.csv   - GameId, White, Black, Date, Player, Color для каждой партии
+
+    Массивы открываются через np.load(mmap_mode='r'), поэтому загрузка не копирует данные в память,
+    а метрики пересчитываются по миллионам позиций без повторного анализа движком.
+
+    Параметры:
+        path (str): Каталог хранилища
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.scores = np.load(os.path.join(path, "scores.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.games = pd.read_csv(os.path.join(path, "games.csv"), dtype=str, keep_default_na=False)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def game_scores(self, index):
+        """Оценки партии index в пешках (как в analyze_games_with_engine)"""
+        return self.scores[self.offsets[index]:self.offsets[index + 1]] / 100
+
+    def to_flat(self):
+        """Возвращает (scores, offsets) в пешках для calculate_metrics_from_flat"""
+        return self.scores / 100, np.asarray(self.offsets)
+
+    def metrics(self, username=None, **thresholds):
+        """
+        Пересчитывает метрики по сохраненным оценкам.
+
+        Параметры:
+            username (str): Ник игрока; если не задан, берется колонка Player из хранилища
+            thresholds: Пороги зевка/ошибки/неточности (см. calculate_metrics_from_flat)
+
+        Возвращает:
+            pd.DataFrame: DataFrame с метриками по партиям (как analyze_player_performance)
+        """
+        games = self.games
+        if username is None:
+            player_is_white = (games["Color"] == "White").to_numpy()
+        else:
+            player_is_white = (games["White"] == username).to_numpy()
+        opponents = np.where(player_is_white, games["Black"], games["White"])
+
+        scores, offsets = self.to_flat()
+        return calculate_metrics_from_flat(scores, offsets, player_is_white, opponents, **thresholds)
+
+    @staticmethod
+    def write(path, games, all_games_scores, username=None, append=False):
+        """
+        Сохраняет оценки партий в хранилище.
+
+        Параметры:
+            path (str): Каталог хранилища (создается при необходимости)
+            games (list): Список объектов chess.pgn.Game или CompactGame
+            all_games_scores (list): Список списков с оценками (результат analyze_games_with_engine)
+            username (str): Ник исследуемого игрока (заполняет колонки Player/Color)
+            append (bool): Дописать партии к существующему хранилищу
+
+        Возвращает:
+            ScoreStore: Открытое хранилище
+        """
+        os.makedirs(path, exist_ok=True)
+
+        scores, offsets = flatten_scores(all_games_scores)
+        centipawns = np.round(scores * 100).astype(np.int16)
+
+        rows = []
+        for game in games:
+            headers = game.headers
+            color = ""
+            if username is not None:
+                color = "White" if headers.get("White") == username else "Black"
+            rows.append({
+                "GameId": game_id_from_headers(headers),
+                "White": headers.get("White", ""),
+                "Black": headers.get("Black", ""),
+                "Date": headers.get("UTCDate") or headers.get("Date", ""),
+                "Player": username or "",
+                "Color": color
+            })
+        metadata = pd.DataFrame(rows, columns=["GameId", "White", "Black", "Date", "Player", "Color"])
+
+        if append and os.path.exists(os.path.join(path, "offsets.npy")):
+            existing = ScoreStore(path)
+            centipawns = np.concatenate([existing.scores, centipawns])
+            offsets = np.concatenate([existing.offsets, existing.offsets[-1] + offsets[1:]])
+            metadata = pd.concat([existing.games, metadata], ignore_index=True)
+            del existing
+
+        # Пишем во временные файлы и переименовываем, чтобы не испортить хранилище, открытое через mmap
+        for name, values in (("scores.npy", centipawns), ("offsets.npy", offsets)):
+            tmp_path = os.path.join(path, name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp_path, os.path.join(path, name))
+        metadata.to_csv(os.path.join(path, "games.csv.tmp"), index=False)
+        os.replace(os.path.join(path, "games.csv.tmp"), os.path.join(path, "games.csv"))
+
+        return ScoreStore(path)
+
+def analyze_player_performance(username, engine_path='/usr/games/stockfish', token='your_token',  end_date=None, days=365, perf_type="blitz", depth=20, n_engines=1, threads=None, hash_mb=None, cache=None, use_pgn_evals=False, engines=None, resolver=None):
     """
     Анализирует партии игрока и возвращает DataFrame с метриками
 
@@ -185,123 +2516,669 @@ def analyze_player_performance(username, engine_path='/usr/games/stockfish', tok
         days (int): За сколько дней партии
         perf_type (str): Тип игры
         depth (int): Глубина анализа
+        n_engines (int): Число параллельно работающих процессов движка
+        threads (int): Опция Threads для каждого процесса движка
+        hash_mb (int): Опция Hash (МБ) для каждого процесса движка
+        cache (EvalCache): Кеш оценок позиций (None - без кеша)
+        use_pgn_evals (bool): Брать серверные оценки Lichess [%eval ...], где они есть, вместо анализа движком
+        engines (EnginePool): Долгоживущие движки (None - движки запускаются на время вызова)
+        resolver (PositionResolver): Книга дебютов и таблицы Syzygy, проверяемые до поиска движком
 
     Возвращает:
         pd.DataFrame: DataFrame с метриками по партиям
     """
-    # 1. Загружаем партии
-    games = get_player_games(username, days=days, perf_type=perf_type, token=token)
+    with metrics_labels(player=username):
+        # 1. Загружаем партии
+        games = get_player_games(username, days=days, perf_type=perf_type, token=token, evals=True if use_pgn_evals else None, compact=True)
 
-    # 2. Анализируем оценки позиций
-    all_games_scores = analyze_games_with_engine(games, engine_path, depth=depth)
+        # 2. Анализируем оценки позиций
+        all_games_scores = analyze_games_with_engine(games, engine_path, depth=depth, n_engines=n_engines, threads=threads, hash_mb=hash_mb, cache=cache, use_pgn_evals=use_pgn_evals, engines=engines, resolver=resolver)
 
-    # 3. Анализируем потери сантипешек
-    all_games_losses = analyze_player_losses(all_games_scores)
+        # 3. Вычисляем потери сантипешек и метрики сразу для всех партий
+        df = calculate_metrics_vectorized(games, all_games_scores, username)
 
-    results = []
+    return df
 
-    for game, game_scores, game_losses in zip(games, all_games_scores, all_games_losses):
-        if not game_scores or not game_losses:
-            continue
+def stream_games_performance(games, username, engine_path='/usr/games/stockfish', depth=20, n_engines=1, threads=None, hash_mb=None, cache=None, queue_depth=16, max_restarts=3, engines=None):
+    """
+    Потоково анализирует партии: каждая партия оценивается сразу после получения, строка метрик отдается сразу после анализа.
 
-        # Определяем цвет игрока
-        player_is_white = (game.headers["White"] == username)
-        opponent = game.headers["Black"] if player_is_white else game.headers["White"]
-
-        # Инициализируем метрики для партии
-        total_accuracy = 0
-        total_moves = 0
-        blunders = 0
-        mistakes = 0
-        inaccuracies = 0
-        total_loss = 0
-
-        # Проходим по всем ходам
-        for i in range(len(game_losses)):
-            if player_is_white:
-                # Для белых анализируем нечетные ходы (1, 3, 5...)
-                if i % 2 == 0:
-                    # Конвертируем оценки в сантипешки
-                    cp_before = game_scores[i] * 100
-                    cp_after = game_scores[i+1] * 100
-
-                    # Вычисляем Win%
-                    win_before = calculate_win_percent(cp_before)
-                    win_after = calculate_win_percent(cp_after)
-                    win_diff = win_before - win_after
-
-                    # Вычисляем Accuracy
-                    accuracy = calculate_accuracy(abs(win_diff))
-                    total_accuracy += accuracy
-                    total_moves += 1
-
-                    # Анализируем потери
-                    loss = game_losses[i]
-                    total_loss += loss
-
-                    if loss > 300:
-                        blunders += 1
-                    elif loss > 100:
-                        mistakes += 1
-                    elif loss > 50:
-                        inaccuracies += 1
-            else:
-                # Для черных анализируем четные ходы (2, 4, 6...)
-                if i % 2 == 1:
-                    # Конвертируем оценки в сантипешки
-                    cp_before = game_scores[i] * 100
-                    cp_after = game_scores[i+1] * 100
-
-                    # Вычисляем Win%
-                    win_before = calculate_win_percent(-cp_before)  # Инвертируем для черных
-                    win_after = calculate_win_percent(-cp_after)
-                    win_diff = win_before - win_after
-
-                    # Вычисляем Accuracy
-                    accuracy = calculate_accuracy(abs(win_diff))
-                    total_accuracy += accuracy
-                    total_moves += 1
-
-                    # Анализируем потери
-                    loss = game_losses[i]
-                    total_loss += loss
-
-                    if loss > 200:
-                        blunders += 1
-                    elif loss > 100:
-                        mistakes += 1
-                    elif loss > 50:
-                        inaccuracies += 1
-
-        # Вычисляем средние значения
-        if total_moves > 0:
-            avg_accuracy = total_accuracy / total_moves
-            avg_loss = total_loss / total_moves
-        else:
-            avg_accuracy = 0
-            avg_loss = 0
-
-        # Добавляем результат партии
-        results.append({
-            "Opponent": opponent,
-            "Color": "White" if player_is_white else "Black",
-            "Accuracy": round(avg_accuracy, 1),
-            "AvgLoss": round(avg_loss, 1),
-            "Blunders": blunders,
-            "Mistakes": mistakes,
-            "Inaccuracies": inaccuracies,
-            "TotalMoves": total_moves
+    Партии читаются из источника в отдельном потоке в очередь ограниченной длины, поэтому в памяти одновременно
+    находится не больше queue_depth + n_engines партий, независимо от их общего числа.
+
+    Параметры:
+        games (iterable): Источник партий chess.pgn.Game (например, iter_player_games)
+        username (str): Ник игрока
+        engine_path (str): Путь к движку
+        depth (int): Глубина анализа
+        n_engines (int): Число параллельно работающих процессов движка
+        threads (int): Опция Threads для каждого процесса движка
+        hash_mb (int): Опция Hash (МБ) для каждого процесса движка
+        cache (EvalCache): Кеш оценок позиций (None - без кеша)
+        queue_depth (int): Максимальное число скачанных, но еще не проанализированных партий
+        max_restarts (int): Сколько раз можно перезапустить упавший движок на одной партии
+        engines (EnginePool): Долгоживущие движки (тогда параллельно работают engines.size движков);
+                              None - движки запускаются на время анализа
+
+    Возвращает:
+        generator: Строки с метриками (как в analyze_player_performance) в порядке поступления партий
+    """
+    games_queue = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Ждем места в очереди, но не зависаем, если потребитель уже закончил
+        while not stop.is_set():
+            try:
+                games_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for game in games:
+                if not put(game):
+                    return
+        except Exception as e:
+            print(f"Ошибка при получении партий: {e}")
+        finally:
+            put(done)
+
+    # Свободные движки: поток анализа берет движок из пула и возвращает его после партии
+    if engines is not None:
+        n_engines = engines.size
+    resources = contextlib.ExitStack()
+    pool = resources.enter_context(engine_pool(engines, engine_path, size=max(1, n_engines), threads=threads, hash_mb=hash_mb))
+
+    def analyze(game):
+        with pool.session() as engine:
+            engine, game_scores = analyze_game_with_restarts(
+                engine, game, depth=depth, cache=cache, engine_path=engine_path,
+                threads=threads, hash_mb=hash_mb, max_restarts=max_restarts
+            )
+        with timed_stage("metrics"):
+            game_losses = analyze_player_losses([game_scores])[0]
+            return calculate_game_metrics(game, game_scores, game_losses, username)
+
+    producer_thread = threading.Thread(target=contextvars.copy_context().run, args=(producer,), daemon=True)
+    producer_thread.start()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, n_engines))
+    pending = deque()
+    progress = tqdm(desc="Анализ партий", unit="game")
+
+    try:
+        while True:
+            game = games_queue.get()
+            if game is done:
+                break
+            pending.append(executor.submit(contextvars.copy_context().run, analyze, game))
+
+            # Не держим в работе больше партий, чем движков: результаты отдаются по порядку
+            while len(pending) >= max(1, n_engines):
+                row = pending.popleft().result()
+                progress.update(1)
+                if row is not None:
+                    yield row
+
+        while pending:
+            row = pending.popleft().result()
+            progress.update(1)
+            if row is not None:
+                yield row
+    finally:
+        stop.set()
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        progress.close()
+        resources.close()
+        if cache is not None:
+            cache.flush()
+
+def stream_player_performance(username, engine_path='/usr/games/stockfish', token='your_token', end_date=None, days=365, perf_type="blitz", depth=20, n_engines=1, threads=None, hash_mb=None, cache=None, queue_depth=16, engines=None):
+    """
+    Потоковая версия analyze_player_performance: партии анализируются по мере скачивания,
+    строки с метриками отдаются сразу, память ограничена длиной очереди queue_depth.
+
+    Пример:
+        df = pd.DataFrame(stream_player_performance('username', token=token))
+
+    Возвращает:
+        generator: Строки с метриками по партиям
+    """
+    games = iter_player_games(username, days=days, perf_type=perf_type, end_date=end_date, token=token)
+
+    return stream_games_performance(
+        games, username, engine_path=engine_path, depth=depth, n_engines=n_engines,
+        threads=threads, hash_mb=hash_mb, cache=cache, queue_depth=queue_depth, engines=engines
+    )
+
+def analyze_players_batch(usernames=None, games=None, tournament_id=None, engine_path='/usr/games/stockfish', token='your_token', end_date=None, days=365, perf_type="blitz", depth=20, n_engines=1, threads=None, hash_mb=None, cache=None, engines=None, schedule=False):
+    """
+    Пакетный анализ нескольких игроков (например, всех участников турнира).
+
+    Партии всех игроков собираются вместе, повторы (партия между двумя участниками) отбрасываются
+    по идентификатору партии, и каждая уникальная партия анализируется движком ровно один раз.
+    Метрики считаются по одному и тому же анализу для обеих сторон партии.
+
+    Параметры:
+        usernames (list): Ники игроков; если партии не заданы, скачиваются партии каждого игрока
+        games (list): Готовый набор партий chess.pgn.Game
+        tournament_id (str): Идентификатор арена-турнира, партии которого нужно проанализировать
+        engine_path (str): Путь к движку
+        end_date, days, perf_type: Период и тип игры при скачивании партий игроков
+        depth (int): Глубина анализа
+        n_engines (int): Число параллельно работающих процессов движка
+        threads (int): Опция Threads для каждого процесса движка
+        hash_mb (int): Опция Hash (МБ) для каждого процесса движка
+        cache (EvalCache): Кеш оценок позиций (None - без кеша)
+        engines (EnginePool): Долгоживущие движки (None - движки запускаются на время вызова)
+        schedule (bool): Искать каждую различную позицию пакета один раз (analyze_games_scheduled)
+
+    Возвращает:
+        dict: Ник игрока -> pd.DataFrame с метриками по его партиям (как analyze_player_performance);
+              если ники не заданы - для всех игроков, встретившихся в партиях
+    """
+    # 1. Собираем партии из всех источников
+    collected = list(games or [])
+    if tournament_id is not None:
+        collected.extend(iter_tournament_games(tournament_id, token=token))
+    if games is None and tournament_id is None and usernames:
+        players_games = fetch_players_games(usernames, days=days, perf_type=perf_type, end_date=end_date, token=token)
+        for username in usernames:
+            collected.extend(players_games[username])
+
+    # 2. Оставляем каждую партию один раз
+    unique_games = {}
+    for game in collected:
+        unique_games.setdefault(game_key(game), game)
+    unique_games = list(unique_games.values())
+    print(f"Уникальных партий: {len(unique_games)} из {len(collected)}")
+
+    # 3. Анализируем уникальные партии
+    if schedule:
+        all_games_scores, _ = analyze_games_scheduled(
+            unique_games, engine_path, depth=depth, n_engines=n_engines, threads=threads, hash_mb=hash_mb, cache=cache, engines=engines
+        )
+    else:
+        all_games_scores = analyze_games_with_engine(
+            unique_games, engine_path, depth=depth, n_engines=n_engines, threads=threads, hash_mb=hash_mb, cache=cache, engines=engines
+        )
+
+    # 4. Раскладываем результаты по игрокам (за обе стороны каждой партии)
+    if usernames is None:
+        usernames = sorted({
+            name for game in unique_games for name in (game.headers.get("White"), game.headers.get("Black")) if name
         })
 
-    # Создаем DataFrame
-    df = pd.DataFrame(results)
+    players_games = {username: [] for username in usernames}
+    for index, game in enumerate(unique_games):
+        for color in ("White", "Black"):
+            name = game.headers.get(color)
+            if name in players_games:
+                players_games[name].append(index)
+
+    results = {}
+    for username, indices in players_games.items():
+        results[username] = calculate_metrics_vectorized(
+            [unique_games[i] for i in indices], [all_games_scores[i] for i in indices], username
+        )
+    return results
 
-    return df
+class AnalysisStore:
+    """
+    Локальное хранилище скачанных и проанализированных партий (SQLite), ключ - идентификатор партии Lichess.
+    Партия с оценками хранится один раз, а к игрокам привязывается отдельной таблицей, поэтому партия двух
+    отслеживаемых игроков анализируется один раз и попадает в метрики обоих.
+
+    Каждая партия и ее оценки сохраняются отдельной транзакцией, поэтому прерванный анализ
+    продолжается с первой партии без оценок. Для скачивания хранится отдельная отметка: до какого времени
+    партии игрока скачаны полностью. Она сдвигается только после того, как поток партий дочитан без ошибок,
+    поэтому прерванная загрузка (Lichess отдает сначала новые партии) повторяется с прежней отметки.
+
+    Параметры:
+        path (str): Путь к файлу хранилища
+    """
+
+    def __init__(self, path='analysis_store.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS games ("
+            "game_id TEXT PRIMARY KEY, played_at INTEGER, pgn TEXT NOT NULL, depth INTEGER, scores TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS player_games ("
+            "username TEXT NOT NULL, perf_type TEXT NOT NULL, game_id TEXT NOT NULL, "
+            "PRIMARY KEY (username, perf_type, game_id))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS fetches ("
+            "username TEXT NOT NULL, perf_type TEXT NOT NULL, fetched_from INTEGER NOT NULL, fetched_until INTEGER NOT NULL, "
+            "PRIMARY KEY (username, perf_type))"
+        )
+        self.connection.commit()
+
+    def fetched_range(self, username, perf_type):
+        """
+        Промежуток (начало, конец) в миллисекундах, за который партии игрока скачаны полностью
+        (None, если полной загрузки еще не было)
+        """
+        row = self.connection.execute(
+            "SELECT fetched_from, fetched_until FROM fetches WHERE username = ? AND perf_type = ?", (username, perf_type)
+        ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def mark_fetched(self, username, perf_type, fetched_from, fetched_until):
+        """Запоминает, что партии игрока за промежуток [fetched_from, fetched_until] скачаны полностью"""
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO fetches (username, perf_type, fetched_from, fetched_until) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(username, perf_type) DO UPDATE SET fetched_from = excluded.fetched_from, "
+                "fetched_until = excluded.fetched_until",
+                (username, perf_type, fetched_from, fetched_until)
+            )
+
+    def add_game(self, game, username, perf_type):
+        """Сохраняет скачанную партию и привязывает ее к игроку (уже сохраненные партии не перезаписываются)"""
+        game_id = game_key(game)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO games (game_id, played_at, pgn) VALUES (?, ?, ?)",
+                (game_id, game_time_from_headers(game.headers), str(game))
+            )
+            self.connection.execute(
+                "INSERT OR IGNORE INTO player_games (username, perf_type, game_id) VALUES (?, ?, ?)",
+                (username, perf_type, game_id)
+            )
+
+    def pending_games(self, username, perf_type, depth):
+        """Партии игрока без оценок (или с оценками меньшей глубины) в порядке времени"""
+        rows = self.connection.execute(
+            "SELECT games.game_id, pgn FROM player_games JOIN games USING (game_id) "
+            "WHERE username = ? AND perf_type = ? AND (scores IS NULL OR depth < ?) ORDER BY played_at",
+            (username, perf_type, depth)
+        ).fetchall()
+        return [(game_id, chess.pgn.read_game(StringIO(pgn))) for game_id, pgn in rows]
+
+    def save_scores(self, game_id, game_scores, depth):
+        """Сохраняет оценки партии (контрольная точка после каждой партии)"""
+        with self.connection:
+            self.connection.execute(
+                "UPDATE games SET scores = ?, depth = ? WHERE game_id = ?", (json.dumps(game_scores), depth, game_id)
+            )
+
+    def analyzed_games(self, username, perf_type, since=None, until=None):
+        """
+        Возвращает (список партий, список оценок) проанализированных партий игрока за период (время в миллисекундах)
+        """
+        query = (
+            "SELECT pgn, scores FROM player_games JOIN games USING (game_id) "
+            "WHERE username = ? AND perf_type = ? AND scores IS NOT NULL"
+        )
+        parameters = [username, perf_type]
+        if since is not None:
+            query += " AND played_at >= ?"
+            parameters.append(since)
+        if until is not None:
+            query += " AND played_at <= ?"
+            parameters.append(until)
+        rows = self.connection.execute(query + " ORDER BY played_at", parameters).fetchall()
+
+        games = [chess.pgn.read_game(StringIO(pgn)) for pgn, _ in rows]
+        all_games_scores = [json.loads(scores) for _, scores in rows]
+        return games, all_games_scores
+
+    def close(self):
+        self.connection.close()
+
+# На сколько раньше конца загрузки ставится отметка полной загрузки: партии, шедшие во время загрузки,
+# скачиваются при следующем запуске
+INCREMENTAL_FETCH_OVERLAP_MS = 24 * 60 * 60 * 1000
+
+def analyze_player_incremental(username, store, engine_path='/usr/games/stockfish', token='your_token', end_date=None, days=365, perf_type="blitz", depth=20, threads=None, hash_mb=None, cache=None, engines=None):
+    """
+    Инкрементальная версия analyze_player_performance.
+
+    Скачивает только партии после отметки полной загрузки в store, анализирует только партии без оценок
+    и сохраняет оценки после каждой партии, поэтому прерванный запуск продолжается с места остановки.
+    Если загрузка партий оборвалась, отметка не сдвигается, а анализ и метрики не считаются.
+
+    Параметры:
+        username (str): Ник игрока
+        store (AnalysisStore или str): Хранилище партий или путь к нему
+        engine_path (str): Путь к движку
+        end_date (datetime): Конечная дата периода для метрик (по умолчанию текущая дата)
+        days (int): За сколько дней партии
+        perf_type (str): Тип игры
+        depth (int): Глубина анализа
+        threads (int): Опция Threads движка
+        hash_mb (int): Опция Hash (МБ) движка
+        cache (EvalCache): Кеш оценок позиций (None - без кеша)
+        engines (EnginePool): Долгоживущие движки (None - движки запускаются на время вызова)
+
+    Возвращает:
+        pd.DataFrame: DataFrame с метриками по партиям периода (как analyze_player_performance)
+                      или None, если скачать партии не удалось
+    """
+    if isinstance(store, str):
+        store = AnalysisStore(store)
+
+    with metrics_labels(player=username):
+        return _analyze_player_incremental(username, store, engine_path, token, end_date, days, perf_type, depth, threads, hash_mb, cache, engines)
+
+def _analyze_player_incremental(username, store, engine_path, token, end_date, days, perf_type, depth, threads, hash_mb, cache, engines):
+    if end_date is None:
+        end_date = datetime.now()
+    elif isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, '%Y-%m-%d')
+    start_date = end_date - timedelta(days=days)
+
+    # 1. Докачиваем партии после отметки полной загрузки. Партии с началом до until, которые еще шли
+    #    во время загрузки, в выгрузку не попадают, поэтому отметка ставится с запасом INCREMENTAL_FETCH_OVERLAP_MS;
+    #    повторно скачанные партии не дублируются (INSERT OR IGNORE)
+    start_millis = berserk.utils.to_millis(start_date)
+    until = berserk.utils.to_millis(datetime.now())
+    fetched = store.fetched_range(username, perf_type)
+    if fetched is not None and fetched[0] <= start_millis:
+        fetched_from, since = fetched[0], fetched[1] + 1
+    else:
+        fetched_from, since = start_millis, start_millis
+
+    try:
+        for game in iter_player_games(username, perf_type=perf_type, token=token, since=since, until=until):
+            store.add_game(game, username, perf_type)
+    except Exception as e:
+        print(f"Ошибка при получении партий: {e}")
+        return None
+    store.mark_fetched(username, perf_type, fetched_from, max(since - 1, until - INCREMENTAL_FETCH_OVERLAP_MS))
+
+    # 2. Анализируем партии без оценок, сохраняя результат после каждой
+    pending = store.pending_games(username, perf_type, depth)
+    if pending:
+        try:
+            with engine_pool(engines, engine_path, threads=threads, hash_mb=hash_mb) as pool, pool.session() as engine:
+                for game_id, game in tqdm(pending, desc="Анализ партий", unit="game"):
+                    engine, game_scores = analyze_game_with_restarts(
+                        engine, game, depth=depth, cache=cache, engine_path=engine_path, threads=threads, hash_mb=hash_mb
+                    )
+                    if game_scores:
+                        store.save_scores(game_id, game_scores, depth)
+        finally:
+            if cache is not None:
+                cache.flush()
+
+    # 3. Считаем метрики по всем проанализированным партиям периода
+    games, all_games_scores = store.analyzed_games(
+        username, perf_type, since=berserk.utils.to_millis(start_date), until=berserk.utils.to_millis(end_date)
+    )
+    return calculate_metrics_vectorized(games, all_games_scores, username)
+
+class WorkQueue:
+    """
+    Очередь заданий анализа на SQLite для нескольких процессов и узлов.
+
+    Координатор (submit) делит партии на задания по job_size партий. Обработчики (run_worker) забирают задание
+    с арендой на lease_seconds, продлевают ее, пока движок работает, и записывают оценки. Запись идемпотентна:
+    оценки партии сохраняются один раз, повторный результат (например, от обработчика, аренду которого уже
+    отдали другому) игнорируется. Задания с истекшей арендой (обработчик упал или потерян) снова выдаются;
+    после max_attempts неудачных попыток задание помечается как failed.
+
+    Файл очереди должен быть доступен всем обработчикам (локальный диск или общая ФС с блокировками).
+
+    Параметры:
+        path (str): Путь к файлу очереди
+        lease_seconds (float): Срок аренды задания
+        max_attempts (int): Сколько раз выдавать задание, прежде чем считать его неудачным
+    """
+
+    def __init__(self, path='work_queue.sqlite', lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id INTEGER PRIMARY KEY, batch TEXT NOT NULL, depth INTEGER NOT NULL, state TEXT NOT NULL, "
+            "worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS games ("
+            "game_id TEXT NOT NULL, batch TEXT NOT NULL, position INTEGER NOT NULL, job_id INTEGER NOT NULL, "
+            "pgn TEXT NOT NULL, depth INTEGER, scores TEXT, PRIMARY KEY (batch, game_id))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS games_job ON games (job_id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS games_batch ON games (batch, position)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE сразу берет блокировку записи: два обработчика не получат одно задание
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def submit(self, games, batch="default", depth=20, job_size=50):
+        """
+        Делит партии на задания (партии, уже поставленные в этот же пакет, пропускаются; партии без идентификатора
+        Lichess узнаются по содержимому, см. game_key)
+
+        Параметры:
+            games (iterable): Партии chess.pgn.Game или CompactGame
+            batch (str): Имя пакета (например, 'baseline-2024-05'), по нему собираются результаты
+            depth (int): Глубина анализа
+            job_size (int): Число партий в задании
+
+        Возвращает:
+            int: Число созданных заданий
+        """
+        with self._transaction() as connection:
+            position = connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM games WHERE batch = ?", (batch,)).fetchone()[0]
+            job_id = None
+            in_job = job_size
+            n_jobs = 0
+            for game in games:
+                game_id = game_key(game)
+                if connection.execute("SELECT 1 FROM games WHERE batch = ? AND game_id = ?", (batch, game_id)).fetchone():
+                    continue
+                if in_job >= job_size:
+                    job_id = connection.execute(
+                        "INSERT INTO jobs (batch, depth, state) VALUES (?, ?, 'pending')", (batch, depth)
+                    ).lastrowid
+                    in_job = 0
+                    n_jobs += 1
+                connection.execute(
+                    "INSERT INTO games (game_id, batch, position, job_id, pgn) VALUES (?, ?, ?, ?, ?)",
+                    (game_id, batch, position, job_id, str(game))
+                )
+                position += 1
+                in_job += 1
+        return n_jobs
+
+    def claim(self, worker):
+        """
+        Берет в аренду следующее задание (свободное или с истекшей арендой)
+
+        Возвращает:
+            dict: job_id, depth и games (список пар (game_id, CompactGame)) или None, если заданий нет
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            # Задания, исчерпавшие попытки, больше не выдаются
+            connection.execute(
+                "UPDATE jobs SET state = 'failed', worker = NULL WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )
+            row = connection.execute(
+                "SELECT job_id, depth FROM jobs WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY job_id LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, depth = row
+            connection.execute(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE job_id = ?",
+                (worker, now + self.lease_seconds, job_id)
+            )
+            rows = connection.execute(
+                "SELECT game_id, pgn FROM games WHERE job_id = ? AND scores IS NULL ORDER BY position", (job_id,)
+            ).fetchall()
+        return {"job_id": job_id, "depth": depth, "games": [(game_id, read_compact_game(pgn)) for game_id, pgn in rows]}
+
+    def heartbeat(self, job_id, worker):
+        """Продлевает аренду; False - аренда потеряна (задание уже отдано другому обработчику или выполнено)"""
+        with self._transaction() as connection:
+            updated = connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND worker = ? AND state = 'leased'",
+                (time.time() + self.lease_seconds, job_id, worker)
+            ).rowcount
+        return updated == 1
+
+    def complete(self, job_id, worker, results, depth):
+        """
+        Записывает оценки партий задания и отмечает его выполненным (идемпотентно)
+
+        Параметры:
+            results (list): Пары (game_id, оценки в формате analyze_games_with_engine); пустые оценки не сохраняются
+        """
+        with self._transaction() as connection:
+            for game_id, game_scores in results:
+                if game_scores:
+                    connection.execute(
+                        "UPDATE games SET scores = ?, depth = ? WHERE game_id = ? AND job_id = ? AND scores IS NULL",
+                        (json.dumps(game_scores), depth, game_id, job_id)
+                    )
+            missing = connection.execute(
+                "SELECT COUNT(*) FROM games WHERE job_id = ? AND scores IS NULL", (job_id,)
+            ).fetchone()[0]
+            if missing == 0:
+                connection.execute("UPDATE jobs SET state = 'done', worker = NULL, lease_until = NULL WHERE job_id = ?", (job_id,))
+            else:
+                self._release(connection, job_id, worker, f"Нет оценок для {missing} партий")
+
+    def fail(self, job_id, worker, error):
+        """Возвращает задание в очередь после ошибки (или помечает failed, если попытки исчерпаны)"""
+        with self._transaction() as connection:
+            self._release(connection, job_id, worker, error)
+
+    def _release(self, connection, job_id, worker, error):
+        connection.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, lease_until = NULL, error = ? WHERE job_id = ? AND worker = ? AND state = 'leased'",
+            (self.max_attempts, str(error), job_id, worker)
+        )
+
+    def requeue_expired(self):
+        """Возвращает в очередь задания потерянных обработчиков (с истекшей арендой); возвращает их число"""
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, lease_until = NULL "
+                "WHERE state = 'leased' AND lease_until < ?", (self.max_attempts, time.time())
+            ).rowcount
+
+    def progress(self, batch=None):
+        """Число заданий по состояниям: pending, leased, done, failed"""
+        query = "SELECT state, COUNT(*) FROM jobs"
+        parameters = []
+        if batch is not None:
+            query += " WHERE batch = ?"
+            parameters.append(batch)
+        counts = dict(self.connection.execute(query + " GROUP BY state", parameters).fetchall())
+        return {state: counts.get(state, 0) for state in ("pending", "leased", "done", "failed")}
+
+    def results(self, batch="default"):
+        """
+        Возвращает (список партий, список оценок) проанализированных партий пакета в порядке постановки
+        """
+        rows = self.connection.execute(
+            "SELECT pgn, scores FROM games WHERE batch = ? AND scores IS NOT NULL ORDER BY position", (batch,)
+        ).fetchall()
+        return [read_compact_game(pgn) for pgn, _ in rows], [json.loads(scores) for _, scores in rows]
+
+    def close(self):
+        self.connection.close()
+
+def run_worker(work_queue, engine_path='/usr/games/stockfish', n_engines=1, threads=None, hash_mb=None, cache=None, resolver=None, worker=None, poll_interval=5.0, exit_when_idle=True):
+    """
+    Обработчик очереди заданий: берет задания в аренду, анализирует их партии analyze_games_with_engine
+    и записывает оценки. Движки живут все время работы обработчика (EnginePool).
+    Можно запускать в нескольких процессах и на нескольких узлах с одним файлом очереди.
+
+    Параметры:
+        work_queue (WorkQueue или str): Очередь или путь к ней
+        engine_path, n_engines, threads, hash_mb, cache, resolver: Как в analyze_games_with_engine
+        worker (str): Идентификатор обработчика (по умолчанию <узел>:<pid>)
+        poll_interval (float): Пауза между проверками пустой очереди, с
+        exit_when_idle (bool): Завершиться, когда не останется ни свободных, ни арендованных заданий
+
+    Возвращает:
+        int: Число выполненных заданий
+    """
+    if isinstance(work_queue, str):
+        work_queue = WorkQueue(work_queue)
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    completed = 0
+
+    with EnginePool(engine_path, size=n_engines, threads=threads, hash_mb=hash_mb) as engines:
+        while True:
+            job = work_queue.claim(worker)
+            if job is None:
+                progress = work_queue.progress()
+                if exit_when_idle and progress["pending"] == 0 and progress["leased"] == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            # Пока движок работает, аренда продлевается в отдельном потоке со своим соединением
+            stop = threading.Event()
+
+            def keep_alive():
+                heartbeat_queue = WorkQueue(work_queue.path, lease_seconds=work_queue.lease_seconds, max_attempts=work_queue.max_attempts)
+                try:
+                    while not stop.wait(work_queue.lease_seconds / 3):
+                        if not heartbeat_queue.heartbeat(job["job_id"], worker):
+                            break
+                finally:
+                    heartbeat_queue.close()
+
+            heartbeat = threading.Thread(target=keep_alive, daemon=True)
+            heartbeat.start()
+            try:
+                game_ids = [game_id for game_id, _ in job["games"]]
+                with metrics_labels(job=job["job_id"]):
+                    all_games_scores = analyze_games_with_engine(
+                        [game for _, game in job["games"]], depth=job["depth"], cache=cache, engines=engines, resolver=resolver
+                    )
+            except Exception as e:
+                stop.set()
+                heartbeat.join()
+                print(f"Ошибка при анализе задания {job['job_id']}: {e}")
+                work_queue.fail(job["job_id"], worker, e)
+                continue
+
+            stop.set()
+            heartbeat.join()
+            work_queue.complete(job["job_id"], worker, list(zip(game_ids, all_games_scores)), job["depth"])
+            completed += 1
 
-def plot_all_metrics(players_stats):
+    if cache is not None:
+        cache.flush()
+    return completed
+
+def plot_all_metrics(players_stats, path=None):
 
     """
-    Выводит гистограммы для всех метрик
+    Выводит гистограммы для всех метрик (или сохраняет их в файл path)
     """
 
     fig, axes = plt.subplots(3, 2, figsize=(12, 12))
@@ -348,13 +3225,13 @@ def plot_all_metrics(players_stats):
     axes[2, 0].grid(True, linestyle='--', alpha=0.6)
 
     plt.tight_layout()
-    plt.show()
+    show_or_save(fig, path)
 
-def normality_check(data):
+def normality_check(data, path=None):
     """
     Проверяет нормальность распределения данных:
     - строит гистограмму с линией среднего,
-    - QQ-plot для проверки нормальности,
+    - QQ-plot для проверки нормальности (график сохраняется в файл path, если он задан),
     - выводит ключевые статистики.
     """
     # Создаем фигуру с двумя subplots
@@ -373,7 +3250,7 @@ def normality_check(data):
     axes[1].grid(True, linestyle='--', alpha=0.6)
 
     plt.tight_layout()
-    plt.show()
+    show_or_save(fig, path)
 
     # Вывод статистический данных
     print('Выборочное среднее:', data.mean())                         # Проверка, равны ли среднее значение, медиана и мода
@@ -390,18 +3267,30 @@ def check_dispersion_equality(data1, data2):
 
     """
     Проверяет равенство дисперсий двух выборок
+    (data1 может быть также BaselineIndex или PreparedBaseline)
     """
 
-    # 1. Проверка, равны ли дисперсии точностей
-    stat_acc, p_acc = stats.bartlett(data1['Normalized Accuracy'], data2['Normalized Accuracy'])
+    if isinstance(data1, BaselineIndex):
+        data1 = data1.query()
+
+    if isinstance(data1, PreparedBaseline):
+        # База задана распределениями: те же критерии, посчитанные по подготовленной базе
+        result = detecting_cheaters_batch(data1, data2.assign(Player=""), correction=None).iloc[0]
+        p_acc, p_loss, p_blun = result["p_var_accuracy"], result["p_var_avgloss"], result["p_var_blunders"]
+    else:
+        # 1. Проверка, равны ли дисперсии точностей
+        stat_acc, p_acc = stats.bartlett(data1['Normalized Accuracy'], data2['Normalized Accuracy'])
 
-    # 2. Проверка, равны ли дисперсии потерь сантипешек
-    stat_loss, p_loss = stats.bartlett(data1['Normalized AvgLoss'], data2['Normalized AvgLoss'])
+        # 2. Проверка, равны ли дисперсии потерь сантипешек
+        stat_loss, p_loss = stats.bartlett(data1['Normalized AvgLoss'], data2['Normalized AvgLoss'])
 
-    # 3. Проверка, равны ли дисперсии числа зевков
-    stat_blun, p_blun = stats.levene(data1['Blunders'], data2['Blunders'], center='median')
+        # 3. Проверка, равны ли дисперсии числа зевков
+        stat_blun, p_blun = stats.levene(data1['Blunders'], data2['Blunders'], center='median')
 
-    # Вывод результатов
+    return _report_dispersion_equality(p_acc, p_loss, p_blun)
+
+def _report_dispersion_equality(p_acc, p_loss, p_blun):
+    """Выводит результаты проверки равенства дисперсий и возвращает их p-value"""
 
     if p_acc < 0.05:
         print("Дисперсии точности в рассматриваемых выборках не равны")
@@ -434,30 +3323,44 @@ def detecting_cheaters(data1, data2):
     Проверяет следующие гипотезы:
     H0: параметры Accuracy, AvgLoss, Blunders в data2 не являются аномальными по отношению к аналогичным параметрам в data1
     H1: H1: точность во 2й выборке выше чем в 1й, потери сантипешек - ниже, число зевков - ниже
+
+    data1 может быть также BaselineIndex (или PreparedBaseline): тогда тесты считаются по индексу базы
     """
 
-    d_acc, d_loss, d_blun = check_dispersion_equality(data1, data2)
+    if isinstance(data1, BaselineIndex):
+        data1 = data1.query()
 
-    # 1. Точность в турнире > общей
-    # Если дисперсии равны - применяем двухвыборочный критерий Стьюдента, если нет - критерий Уэлча
-    if d_acc > 0.5:
-      stat_acc, p_acc = stats.ttest_ind(data2['Accuracy'], data1['Accuracy'], alternative='greater', equal_var=True)
+    started = time.perf_counter()
+
+    if isinstance(data1, PreparedBaseline):
+        # Один пакетный расчет дает и проверку дисперсий, и тесты средних
+        result = detecting_cheaters_batch(data1, data2.assign(Player=""), correction=None).iloc[0]
+        _report_dispersion_equality(result["p_var_accuracy"], result["p_var_avgloss"], result["p_var_blunders"])
+        p_acc, p_loss, p_blun = result["p_accuracy"], result["p_avgloss"], result["p_blunders"]
     else:
-      stat_acc, p_acc = stats.ttest_ind(data2['Accuracy'], data1['Accuracy'], alternative='greater', equal_var=False)
+        d_acc, d_loss, d_blun = check_dispersion_equality(data1, data2)
+
+        # 1. Точность в турнире > общей
+        # Если дисперсии равны - применяем двухвыборочный критерий Стьюдента, если нет - критерий Уэлча
+        if d_acc > 0.5:
+          stat_acc, p_acc = stats.ttest_ind(data2['Accuracy'], data1['Accuracy'], alternative='greater', equal_var=True)
+        else:
+          stat_acc, p_acc = stats.ttest_ind(data2['Accuracy'], data1['Accuracy'], alternative='greater', equal_var=False)
 
 
-    # 2. Потери сантипешек в турнире < общих
-    # Если дисперсии равны - применяем двухвыборочный критерий Стьюдента, если нет - критерий Уэлча
-    if d_loss > 0.5:
-      stat_loss, p_loss = stats.ttest_ind(data2['AvgLoss'], data1['AvgLoss'], alternative='less', equal_var=True)
-    else:
-      stat_loss, p_loss = stats.ttest_ind(data2['AvgLoss'], data1['AvgLoss'], alternative='less', equal_var=False)
+        # 2. Потери сантипешек в турнире < общих
+        # Если дисперсии равны - применяем двухвыборочный критерий Стьюдента, если нет - критерий Уэлча
+        if d_loss > 0.5:
+          stat_loss, p_loss = stats.ttest_ind(data2['AvgLoss'], data1['AvgLoss'], alternative='less', equal_var=True)
+        else:
+          stat_loss, p_loss = stats.ttest_ind(data2['AvgLoss'], data1['AvgLoss'], alternative='less', equal_var=False)
 
-    # 3. Зевков в турнире < общих
-    # Статистика по зевкам скорее всего не является нормальной, используем критерий Манна-Уитти
+        # 3. Зевков в турнире < общих
+        # Статистика по зевкам скорее всего не является нормальной, используем критерий Манна-Уитти
 
-    stat_blun, p_blun = stats.mannwhitneyu(data2['Blunders'], data1['Blunders'], alternative='less')
+        stat_blun, p_blun = stats.mannwhitneyu(data2['Blunders'], data1['Blunders'], alternative='less')
 
+    emit_metric("stage", stage="statistical_test", seconds=time.perf_counter() - started)
 
     # Вывод результатов
     print(f"Проверка, равна ли точность в рассматриваемых партиях общей: p-value = {p_acc:.4f}")
@@ -491,16 +3394,29 @@ def detecting_cheaters_if_distributions_are_not_normal(data1, data2):
     Проверяет следующие гипотезы:
     H0: параметры Accuracy, AvgLoss, Blunders в data2 не являются аномальными по отношению к аналогичным параметрам в data1
     H1: H1: точность во 2й выборке выше чем в 1й, потери сантипешек - ниже, число зевков - ниже
+
+    data1 может быть также BaselineIndex (или PreparedBaseline): тогда тесты считаются по индексу базы
     """
 
-    # 1. Точность в турнире > общей
-    stat_acc, p_acc = stats.mannwhitneyu(data2['Accuracy'], data1['Accuracy'], alternative='greater')
+    if isinstance(data1, BaselineIndex):
+        data1 = data1.query()
+
+    started = time.perf_counter()
+
+    if isinstance(data1, PreparedBaseline):
+        result = detecting_cheaters_batch(data1, data2.assign(Player=""), correction=None).iloc[0]
+        p_acc, p_loss, p_blun = result["p_accuracy_mw"], result["p_avgloss_mw"], result["p_blunders"]
+    else:
+        # 1. Точность в турнире > общей
+        stat_acc, p_acc = stats.mannwhitneyu(data2['Accuracy'], data1['Accuracy'], alternative='greater')
+
+        # 2. Потери сантипешек в турнире < общих
+        stat_loss, p_loss = stats.mannwhitneyu(data2['AvgLoss'], data1['AvgLoss'], alternative='less')
 
-    # 2. Потери сантипешек в турнире < общих
-    stat_loss, p_loss = stats.mannwhitneyu(data2['AvgLoss'], data1['AvgLoss'], alternative='less')
+        # 3. Зевков в турнире < общих
+        stat_blun, p_blun = stats.mannwhitneyu(data2['Blunders'], data1['Blunders'], alternative='less')
 
-    # 3. Зевков в турнире < общих
-    stat_blun, p_blun = stats.mannwhitneyu(data2['Blunders'], data1['Blunders'], alternative='less')
+    emit_metric("stage", stage="statistical_test", seconds=time.perf_counter() - started)
 
     # Вывод результатов
     print(f"Точность в рассматриваемых партиях равна общей: p-value = {p_acc:.4f}")
@@ -526,48 +3442,862 @@ def detecting_cheaters_if_distributions_are_not_normal(data1, data2):
         print("Число зевков в рассмотренных партиях не являются аномально низкими")
 
 
-#main
-"""# Выгрузка и анализ партий"""
+class BaselineDistribution:
+    """
+    Распределение одной метрики базовой выборки в виде отсортированных уникальных значений и их частот.
+
+    Метрики округлены до 0.1 (Accuracy, AvgLoss) или целые (Blunders), поэтому такое представление компактно,
+    а все статистики для тестов (среднее, дисперсия, медиана, ранги для Манна-Уитни) считаются из него точно.
+
+    Параметры:
+        values (array-like): Значения
+        counts (array-like): Частоты значений (по умолчанию 1)
+    """
+
+    def __init__(self, values, counts=None):
+        values = np.asarray(values, dtype=np.float64)
+        counts = np.ones(len(values), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+        # Сводим к уникальным отсортированным значениям
+        self.values, inverse = np.unique(values, return_inverse=True)
+        self.counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(self.values)).astype(np.int64)
+        self.cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+
+        self.n = int(self.cumulative[-1])
+        self.mean = float(np.dot(self.values, self.counts) / self.n)
+        self.var = float(np.dot((self.values - self.mean) ** 2, self.counts) / (self.n - 1)) if self.n > 1 else float("nan")
+        self.tie_term = float(np.sum(self.counts.astype(np.float64) ** 3 - self.counts))
+
+        # Медиана как в np.median: среднее двух центральных порядковых статистик
+        middle = np.searchsorted(self.cumulative[1:], [(self.n - 1) // 2, self.n // 2], side="right")
+        self.median = float(self.values[middle].mean())
+
+        # Для критерия Левене: отклонения от медианы
+        deviations = np.abs(self.values - self.median)
+        self.deviation_mean = float(np.dot(deviations, self.counts) / self.n)
+        self.deviation_ss = float(np.dot((deviations - self.deviation_mean) ** 2, self.counts))
+
+    def transform(self, function):
+        """Распределение преобразованной метрики (например, Normalized AvgLoss = AvgLoss ** 0.5)"""
+        return BaselineDistribution(function(self.values), self.counts)
+
+    def less_equal(self, x):
+        """Для каждого x возвращает (число значений выборки < x, число значений == x)"""
+        x = np.asarray(x, dtype=np.float64)
+        left = self.cumulative[np.searchsorted(self.values, x, side="left")]
+        right = self.cumulative[np.searchsorted(self.values, x, side="right")]
+        return left, right - left
+
+class PreparedBaseline:
+    """
+    Базовая выборка, подготовленная один раз для проверки многих подозреваемых наборов партий
+    (см. detecting_cheaters_batch).
+
+    Параметры:
+        data (pd.DataFrame): Общий набор партий (как players_stats)
+    """
+
+    metrics = ("Accuracy", "AvgLoss", "Blunders")
+
+    def __init__(self, data=None, distributions=None):
+        if distributions is None:
+            distributions = {metric: BaselineDistribution(data[metric].to_numpy()) for metric in self.metrics}
+        self.distributions = dict(distributions)
+
+        # Нормализующие преобразования, как в основном блоке ноутбука
+        self.distributions.setdefault("Normalized AvgLoss", self.distributions["AvgLoss"].transform(np.sqrt))
+        self.distributions.setdefault("Normalized Accuracy", self.distributions["Accuracy"].transform(np.square))
+
+    @classmethod
+    def from_distributions(cls, distributions):
+        """Создает базу из готовых распределений метрик (dict: метрика -> BaselineDistribution)"""
+        return cls(distributions=distributions)
+
+    def __getitem__(self, metric):
+        return self.distributions[metric]
+
+def _group_stats(values, groups, n_groups):
+    """Размер, среднее и дисперсия (ddof=1) значений по группам"""
+    n = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    sums = np.bincount(groups, weights=values, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / n
+        var = np.bincount(groups, weights=(values - mean[groups]) ** 2, minlength=n_groups) / (n - 1)
+    return n, mean, var
+
+def _batch_ttest(baseline, values, groups, n_groups, alternative, equal_var):
+    """Двухвыборочный t-критерий (подозреваемые против базы) для всех групп сразу, как stats.ttest_ind"""
+    n2, mean2, var2 = _group_stats(values, groups, n_groups)
+    n1, mean1, var1 = baseline.n, baseline.mean, baseline.var
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Критерий Стьюдента
+        pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / (n1 + n2 - 2)
+        se_student = np.sqrt(pooled * (1 / n1 + 1 / n2))
+        df_student = n1 + n2 - 2
+
+        # Критерий Уэлча
+        v1, v2 = var1 / n1, var2 / n2
+        se_welch = np.sqrt(v1 + v2)
+        df_welch = (v1 + v2) ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1))
+
+        se = np.where(equal_var, se_student, se_welch)
+        df = np.where(equal_var, df_student, df_welch)
+        t = (mean2 - mean1) / se
+
+    if alternative == "greater":
+        return stats.t.sf(t, df)
+    return stats.t.cdf(t, df)
+
+def _batch_bartlett(baseline, values, groups, n_groups):
+    """Критерий Бартлетта (две выборки: база и группа) для всех групп сразу, как stats.bartlett"""
+    n2, _, var2 = _group_stats(values, groups, n_groups)
+    n1, var1 = baseline.n, baseline.var
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = n1 + n2
+        pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / (total - 2)
+        numerator = (total - 2) * np.log(pooled) - (n1 - 1) * np.log(var1) - (n2 - 1) * np.log(var2)
+        denominator = 1 + (1 / (n1 - 1) + 1 / (n2 - 1) - 1 / (total - 2)) / 3
+        statistic = numerator / denominator
+    return stats.chi2.sf(statistic, 1)
+
+def _batch_levene(baseline, values, groups, n_groups):
+    """Критерий Левене с центром в медиане (база и группа) для всех групп сразу, как stats.levene(center='median')"""
+    medians = pd.Series(values).groupby(groups).median().reindex(range(n_groups)).to_numpy()
+    deviations = np.abs(values - medians[groups])
+    n2, mean2, var2 = _group_stats(deviations, groups, n_groups)
+    n1, mean1 = baseline.n, baseline.deviation_mean
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = n1 + n2
+        grand_mean = (n1 * mean1 + n2 * mean2) / total
+        between = n1 * (mean1 - grand_mean) ** 2 + n2 * (mean2 - grand_mean) ** 2
+        within = baseline.deviation_ss + var2 * (n2 - 1)
+        statistic = (total - 2) * between / within
+    return stats.f.sf(statistic, 1, total - 2)
+
+def _batch_mannwhitneyu(baseline, values, groups, n_groups, alternative):
+    """
+    Критерий Манна-Уитни (асимптотический, с поправками на связи и непрерывность, как stats.mannwhitneyu)
+    для всех групп сразу. Ранги считаются бинарным поиском по отсортированной базе.
+    """
+    less, equal = baseline.less_equal(values)
+    u1 = np.bincount(groups, weights=less + 0.5 * equal, minlength=n_groups)
+    m = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    n = baseline.n
+    total = n + m
+
+    # Связи в объединенной выборке: база + вклад значений группы
+    tied = pd.DataFrame({"group": groups, "value": values, "base": equal}).groupby(["group", "value"], sort=False)
+    tied = tied.agg(count=("base", "size"), base=("base", "first"))
+    joint = tied["count"].to_numpy(dtype=np.float64) + tied["base"].to_numpy(dtype=np.float64)
+    base = tied["base"].to_numpy(dtype=np.float64)
+    extra = (joint ** 3 - joint) - (base ** 3 - base)
+    tie_term = baseline.tie_term + np.bincount(tied.index.get_level_values("group"), weights=extra, minlength=n_groups)
+
+    u = u1 if alternative == "greater" else n * m - u1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mu = n * m / 2
+        s = np.sqrt(n * m / 12 * ((total + 1) - tie_term / (total * (total - 1))))
+        z = (u - mu - 0.5) / s
+    return np.clip(stats.norm.sf(z), 0, 1)
+
+class RunningMetric:
+    """
+    Потоковые достаточные статистики одной метрики: среднее и дисперсия по Уэлфорду
+    и точный скетч распределения (частоты значений, округленных до 0.1). Обновление - O(1).
+    """
+
+    def __init__(self, n=0, mean=0.0, m2=0.0, counts=None):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.counts = counts if counts is not None else {}
+
+    def add(self, value):
+        value = float(value)
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        key = round(value, 1)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def merge(self, other):
+        """Объединяет статистики двух непересекающихся выборок (параллельная формула Уэлфорда)"""
+        n = self.n + other.n
+        if n == 0:
+            return RunningMetric()
+        delta = other.mean - self.mean
+        counts = dict(self.counts)
+        for key, count in other.counts.items():
+            counts[key] = counts.get(key, 0) + count
+        return RunningMetric(
+            n=n,
+            mean=self.mean + delta * other.n / n,
+            m2=self.m2 + other.m2 + delta ** 2 * self.n * other.n / n,
+            counts=counts
+        )
+
+    @property
+    def var(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else float("nan")
+
+    def distribution(self):
+        """Распределение для тестов (BaselineDistribution)"""
+        return BaselineDistribution(list(self.counts.keys()), list(self.counts.values()))
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2, "counts": [[key, count] for key, count in self.counts.items()]}
 
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["n"], data["mean"], data["m2"], {float(key): int(count) for key, count in data["counts"]})
 
-players_stats = pd.read_csv('players_stats.csv')
-players_stats = players_stats[players_stats['TotalMoves'] > 1]
+class BaselineIndex:
+    """
+    Постоянный индекс базовой выборки, разбитый на страты (тип игры, цвет, рейтинговый диапазон).
 
-tournament_stats = pd.read_csv('tournament_stats.csv')
+    Для Accuracy, AvgLoss и Blunders в каждой страте хранятся потоковые статистики (RunningMetric),
+    поэтому новая партия добавляется за O(1), а сравнение подозреваемого с базой из миллионов партий
+    не требует загружать сами партии. Нормализованные метрики (AvgLoss ** 0.5, Accuracy ** 2) считаются
+    из скетча точно. Индекс можно передать в detecting_cheaters вместо DataFrame с базой.
 
-players_stats.describe().apply(lambda x: round(x, 1))
+    Параметры:
+        path (str): JSON-файл индекса (загружается, если существует)
+        rating_band (int): Ширина рейтингового диапазона
+    """
 
-tournament_stats.describe().apply(lambda x: round(x, 1))
+    metrics = ("Accuracy", "AvgLoss", "Blunders")
+
+    def __init__(self, path=None, rating_band=200):
+        self.path = path
+        self.rating_band = rating_band
+        self.strata = {}                               # (perf_type, color, band) -> {метрика: RunningMetric}
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def band(self, rating):
+        """Нижняя граница рейтингового диапазона (None, если рейтинг неизвестен)"""
+        if rating is None or rating != rating:
+            return None
+        return int(rating) // self.rating_band * self.rating_band
+
+    def add(self, row, perf_type=None, rating=None):
+        """
+        Добавляет одну партию.
+
+        Параметры:
+            row (dict или pd.Series): Строка метрик (как в analyze_player_performance)
+            perf_type (str): Тип игры
+            rating (int): Рейтинг игрока в партии
+        """
+        key = (perf_type, row["Color"], self.band(rating))
+        stratum = self.strata.get(key)
+        if stratum is None:
+            stratum = self.strata[key] = {metric: RunningMetric() for metric in self.metrics}
+        for metric in self.metrics:
+            stratum[metric].add(row[metric])
+
+    def add_dataframe(self, data, perf_type=None, rating=None, rating_column="Rating"):
+        """Добавляет все партии DataFrame (рейтинг берется из rating_column, если такая колонка есть)"""
+        ratings = data[rating_column] if rating_column in data.columns else [rating] * len(data)
+        for row, row_rating in zip(data.to_dict("records"), ratings):
+            self.add(row, perf_type=perf_type, rating=row_rating)
+
+    def add_games(self, games, all_games_scores, username):
+        """
+        Добавляет проанализированные партии игрока; тип игры и рейтинг берутся из заголовков PGN
+        """
+        for game, game_scores in zip(games, all_games_scores):
+            row = calculate_game_metrics(game, game_scores, analyze_player_losses([game_scores])[0], username)
+            if row is None:
+                continue
+            rating = game.headers.get("WhiteElo" if row["Color"] == "White" else "BlackElo")
+            self.add(row, perf_type=perf_type_from_headers(game.headers), rating=int(rating) if rating and rating.isdigit() else None)
 
-plot_all_metrics(players_stats=players_stats)
+    def _select(self, perf_type=None, color=None, rating_min=None, rating_max=None):
+        selected = {metric: RunningMetric() for metric in self.metrics}
+        for (stratum_perf_type, stratum_color, band), stratum in self.strata.items():
+            if perf_type is not None and stratum_perf_type != perf_type:
+                continue
+            if color is not None and stratum_color != color:
+                continue
+            if rating_min is not None and (band is None or band + self.rating_band <= rating_min):
+                continue
+            if rating_max is not None and (band is None or band > rating_max):
+                continue
+            for metric in self.metrics:
+                selected[metric] = selected[metric].merge(stratum[metric])
+        return selected
+
+    def summary(self, perf_type=None, color=None, rating_min=None, rating_max=None):
+        """Число партий, среднее и стандартное отклонение метрик выбранных страт"""
+        selected = self._select(perf_type, color, rating_min, rating_max)
+        return pd.DataFrame({
+            metric: {"count": running.n, "mean": running.mean, "std": math.sqrt(running.var) if running.n > 1 else float("nan")}
+            for metric, running in selected.items()
+        })
 
-normality_check(players_stats['AvgLoss'])
+    def query(self, perf_type=None, color=None, rating_min=None, rating_max=None):
+        """
+        Возвращает базу для тестов (PreparedBaseline) по выбранным стратам; None в фильтре - все значения.
+        Страта входит в выборку, если ее рейтинговый диапазон пересекается с [rating_min, rating_max].
+        """
+        selected = self._select(perf_type, color, rating_min, rating_max)
+        if selected["Accuracy"].n == 0:
+            raise ValueError("В индексе нет партий, подходящих под фильтр")
+        return PreparedBaseline.from_distributions({metric: running.distribution() for metric, running in selected.items()})
+
+    def save(self, path=None):
+        """Сохраняет индекс в JSON"""
+        path = path or self.path
+        data = {
+            "rating_band": self.rating_band,
+            "strata": [
+                {"perf_type": perf_type, "color": color, "band": band, "metrics": {metric: running.to_dict() for metric, running in stratum.items()}}
+                for (perf_type, color, band), stratum in self.strata.items()
+            ]
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        self.rating_band = data["rating_band"]
+        self.strata = {
+            (stratum["perf_type"], stratum["color"], stratum["band"]): {
+                metric: RunningMetric.from_dict(running) for metric, running in stratum["metrics"].items()
+            }
+            for stratum in data["strata"]
+        }
+
+def detecting_cheaters_batch(baseline, suspects, group_column="Player", alpha=0.05, correction="fdr_bh"):
+    """
+    Пакетная проверка многих подозреваемых наборов партий против одной базовой выборки.
 
-players_stats['Normalized AvgLoss'] = players_stats['AvgLoss'].apply(lambda x: x ** 0.5)
+    Для каждого набора выполняются те же тесты, что в detecting_cheaters (проверка равенства дисперсий,
+    критерий Стьюдента/Уэлча для Accuracy и AvgLoss, Манна-Уитни для Blunders) и в
+    detecting_cheaters_if_distributions_are_not_normal (Манна-Уитни для всех трех метрик), но база
+    подготавливается один раз, а статистики считаются векторно сразу для всех наборов.
+    К p-value каждого теста применяется поправка на множественные сравнения по всем наборам.
 
-normality_check(players_stats['Normalized AvgLoss'])
+    Параметры:
+        baseline (pd.DataFrame или PreparedBaseline): Общий набор партий
+        suspects (pd.DataFrame или dict): Партии подозреваемых с колонкой group_column
+                                          или словарь имя набора -> DataFrame
+        group_column (str): Колонка с именем набора (например, ник игрока)
+        alpha (float): Уровень значимости
+        correction (str): Метод поправки statsmodels.stats.multitest.multipletests ('fdr_bh', 'holm', 'bonferroni', ...)
+                          или None
 
-normality_check(players_stats['Accuracy'])
+    Возвращает:
+        pd.DataFrame: По строке на набор: число партий, p-value тестов дисперсий, p-value тестов средних
+                      (с поправкой в колонках *_adj) и вердикты anomalous_*
+    """
+    if not isinstance(baseline, PreparedBaseline):
+        baseline = PreparedBaseline(baseline)
 
-players_stats['Normalized Accuracy'] = players_stats['Accuracy'].apply(lambda x: x ** 2)
+    if isinstance(suspects, dict):
+        suspects = pd.concat(
+            [df.assign(**{group_column: name}) for name, df in suspects.items()], ignore_index=True
+        )
 
-normality_check(players_stats['Normalized Accuracy'])
+    started = time.perf_counter()
+
+    codes, names = pd.factorize(suspects[group_column], sort=True)
+    n_groups = len(names)
+
+    def column(metric):
+        return suspects[metric].to_numpy(dtype=np.float64)
+
+    accuracy = column("Accuracy")
+    avg_loss = column("AvgLoss")
+    blunders = column("Blunders")
+
+    # Проверка равенства дисперсий (как check_dispersion_equality)
+    p_var_accuracy = _batch_bartlett(baseline["Normalized Accuracy"], accuracy ** 2, codes, n_groups)
+    p_var_avg_loss = _batch_bartlett(baseline["Normalized AvgLoss"], np.sqrt(avg_loss), codes, n_groups)
+    p_var_blunders = _batch_levene(baseline["Blunders"], blunders, codes, n_groups)
+
+    # Тесты detecting_cheaters: порог 0.5 для выбора между Стьюдентом и Уэлчем, как в исходной функции
+    results = pd.DataFrame({
+        group_column: names,
+        "Games": np.bincount(codes, minlength=n_groups),
+        "p_var_accuracy": p_var_accuracy,
+        "p_var_avgloss": p_var_avg_loss,
+        "p_var_blunders": p_var_blunders,
+        "p_accuracy": _batch_ttest(baseline["Accuracy"], accuracy, codes, n_groups, "greater", p_var_accuracy > 0.5),
+        "p_avgloss": _batch_ttest(baseline["AvgLoss"], avg_loss, codes, n_groups, "less", p_var_avg_loss > 0.5),
+        "p_blunders": _batch_mannwhitneyu(baseline["Blunders"], blunders, codes, n_groups, "less"),
+        # Тесты detecting_cheaters_if_distributions_are_not_normal
+        "p_accuracy_mw": _batch_mannwhitneyu(baseline["Accuracy"], accuracy, codes, n_groups, "greater"),
+        "p_avgloss_mw": _batch_mannwhitneyu(baseline["AvgLoss"], avg_loss, codes, n_groups, "less"),
+    })
+
+    if correction:
+        # Необязательная зависимость: нужна только для поправки на множественные сравнения
+        from statsmodels.stats.multitest import multipletests
+
+    for test in ("p_accuracy", "p_avgloss", "p_blunders", "p_accuracy_mw", "p_avgloss_mw"):
+        p_values = results[test].to_numpy()
+        adjusted = p_values.copy()
+        valid = ~np.isnan(p_values)
+        if correction and valid.any():
+            adjusted[valid] = multipletests(p_values[valid], alpha=alpha, method=correction)[1]
+        results[f"{test}_adj"] = adjusted
+
+    results["anomalous_accuracy"] = results["p_accuracy_adj"] < alpha
+    results["anomalous_avgloss"] = results["p_avgloss_adj"] < alpha
+    results["anomalous_blunders"] = results["p_blunders_adj"] < alpha
+
+    emit_metric("stage", stage="statistical_test", seconds=time.perf_counter() - started)
+    return results
+
+class SequentialTest:
+    """
+    Последовательный критерий отношения правдоподобия (SPRT Вальда) для метрик подозреваемого против базы.
 
-tournament_stats['Normalized AvgLoss'] = tournament_stats['AvgLoss'].apply(lambda x: x ** 0.5)
+    Для каждой метрики проверяется H0: среднее равно среднему базы, против H1: среднее сдвинуто на effect
+    стандартных отклонений базы в сторону читерства (Accuracy выше, AvgLoss и Blunders ниже). Метрики партий
+    считаются нормальными с дисперсией базы. Решение принимается после каждой порции партий (групповой
+    последовательный вариант): лог-отношение правдоподобия выше log((1 - beta) / alpha_m) - аномалия,
+    ниже log(beta / (1 - alpha_m)) - норма. alpha делится между тремя метриками (поправка Бонферрони),
+    поэтому вероятность ложного вердикта 'anomalous' не больше alpha.
 
-tournament_stats['Normalized Accuracy'] = tournament_stats['Accuracy'].apply(lambda x: x ** 2)
+    Общий вердикт: 'anomalous', как только аномальна хотя бы одна метрика; 'normal', когда все метрики приняли H0;
+    иначе None (нужны еще партии).
 
-tournament_stats['Normalized AvgLoss'] = tournament_stats['AvgLoss'].apply(lambda x: x ** 0.5)
+    Параметры:
+        baseline (pd.DataFrame, PreparedBaseline или BaselineIndex): Общий набор партий
+        alpha (float): Вероятность ошибки первого рода (ложно признать партии аномальными)
+        beta (float): Вероятность ошибки второго рода (пропустить сдвиг величиной effect)
+        effect (float): Сдвиг среднего при H1 в стандартных отклонениях базы
+    """
 
-normality_check(tournament_stats['Normalized AvgLoss'])
+    directions = {"Accuracy": 1.0, "AvgLoss": -1.0, "Blunders": -1.0}
+
+    def __init__(self, baseline, alpha=0.05, beta=0.2, effect=0.5):
+        if isinstance(baseline, BaselineIndex):
+            baseline = baseline.query()
+        elif not isinstance(baseline, PreparedBaseline):
+            baseline = PreparedBaseline(baseline)
+        alpha_metric = alpha / len(self.directions)
+        self.upper = math.log((1 - beta) / alpha_metric)
+        self.lower = math.log(beta / (1 - alpha_metric))
+        self.alpha = alpha
+        self.beta = beta
+        self.effect = effect
+        self.parameters = {
+            metric: (baseline[metric].mean, baseline[metric].var) for metric in self.directions
+        }
+        self.llr = {metric: 0.0 for metric in self.directions}
+        self.decisions = {metric: None for metric in self.directions}
+        self.decided_at = {metric: None for metric in self.directions}
+        self.n = 0
+
+    def update(self, rows):
+        """
+        Добавляет порцию партий (DataFrame с метриками, как в analyze_player_performance) и проверяет границы
+
+        Возвращает:
+            str: Текущий общий вердикт ('anomalous', 'normal' или None)
+        """
+        self.n += len(rows)
+        for metric, direction in self.directions.items():
+            if self.decisions[metric] is not None or len(rows) == 0:
+                continue
+            mean, var = self.parameters[metric]
+            shift = direction * self.effect * math.sqrt(var)
+            values = rows[metric].to_numpy(dtype=np.float64)
+            self.llr[metric] += float(np.sum(shift * (values - mean - shift / 2)) / var)
+            if self.llr[metric] >= self.upper:
+                self.decisions[metric] = "anomalous"
+            elif self.llr[metric] <= self.lower:
+                self.decisions[metric] = "normal"
+            if self.decisions[metric] is not None:
+                self.decided_at[metric] = self.n
+        return self.verdict
+
+    @property
+    def verdict(self):
+        decisions = list(self.decisions.values())
+        if "anomalous" in decisions:
+            return "anomalous"
+        if all(decision == "normal" for decision in decisions):
+            return "normal"
+        return None
+
+def detecting_cheaters_sequential(games, username, baseline, engine_path='/usr/games/stockfish', depth=20, batch_size=10, max_games=None, alpha=0.05, beta=0.2, effect=0.5, n_engines=1, threads=None, hash_mb=None, cache=None, engines=None, resolver=None):
+    """
+    Последовательная проверка подозреваемого: партии анализируются порциями по batch_size, после каждой порции
+    обновляется SequentialTest, и анализ прекращается, как только достигнута граница решения.
+    Для явных случаев (читер или чистый аккаунт) движку отправляется лишь часть партий.
 
-tournament_stats['Normalized Accuracy'] = tournament_stats['Accuracy'].apply(lambda x: x ** 2)
+    Параметры:
+        games (iterable): Партии подозреваемого (список или генератор, например iter_player_games(..., compact=True));
+                          генератор читается только до остановки
+        username (str): Ник подозреваемого
+        baseline (pd.DataFrame, PreparedBaseline или BaselineIndex): Общий набор партий
+        engine_path, depth, n_engines, threads, hash_mb, cache, engines, resolver: Как в analyze_games_with_engine
+        batch_size (int): Число партий в порции (границы проверяются после каждой порции)
+        max_games (int): Максимальное число партий (None - пока не кончатся партии)
+        alpha, beta, effect: Параметры SequentialTest
 
-normality_check(tournament_stats['Normalized Accuracy'])
+    Возвращает:
+        dict: verdict ('anomalous', 'normal' или 'undecided'), games (сколько партий понадобилось),
+              metrics (по метрике: решение, число партий, лог-отношение правдоподобия),
+              tests (p-value тестов detecting_cheaters_batch по проанализированным партиям), data (их метрики)
+    """
+    if isinstance(baseline, BaselineIndex):
+        baseline = baseline.query()
+    elif not isinstance(baseline, PreparedBaseline):
+        baseline = PreparedBaseline(baseline)
+
+    test = SequentialTest(baseline, alpha=alpha, beta=beta, effect=effect)
+    games = iter(games)
+    analyzed = []
+
+    with engine_pool(engines, engine_path, size=n_engines, threads=threads, hash_mb=hash_mb) as pool:
+        while max_games is None or test.n < max_games:
+            size = batch_size if max_games is None else min(batch_size, max_games - test.n)
+            batch = [game for _, game in zip(range(size), games)]
+            if not batch:
+                break
+            all_games_scores = analyze_games_with_engine(batch, depth=depth, cache=cache, engines=pool, resolver=resolver)
+            rows = calculate_metrics_vectorized(batch, all_games_scores, username)
+            analyzed.append(rows)
+            if test.update(rows) is not None:
+                break
+
+    data = pd.concat(analyzed, ignore_index=True) if analyzed else pd.DataFrame(columns=["Accuracy", "AvgLoss", "Blunders"])
+    tests = None
+    if len(data) > 1:
+        tests = detecting_cheaters_batch(baseline, data.assign(Player=username), correction=None).iloc[0].to_dict()
+
+    verdict = test.verdict or "undecided"
+    print(f"Последовательная проверка {username}: {verdict}, проанализировано партий: {test.n}")
+    for metric in test.directions:
+        decision = test.decisions[metric] or "нет решения"
+        print(f"  {metric}: {decision} (партий: {test.decided_at[metric] or test.n}, LLR = {test.llr[metric]:.2f})")
+
+    return {
+        "verdict": verdict,
+        "games": test.n,
+        "metrics": {
+            metric: {"decision": test.decisions[metric], "games": test.decided_at[metric], "llr": test.llr[metric]}
+            for metric in test.directions
+        },
+        "tests": tests,
+        "data": data
+    }
+
+"""# Командная строка"""
+
+def read_pgn_file(path, compact=False, processes=None):
+    """
+    Читает все партии из (сжатого) PGN-файла
 
-check_dispersion_equality(players_stats, tournament_stats)
+    Параметры:
+        path (str): Путь к файлу (.pgn, .pgn.bz2, .pgn.zst)
+        compact (bool): Разбирать партии в CompactGame
+        processes (int): Число процессов для разбора CompactGame
 
-detecting_cheaters(players_stats, tournament_stats)
+    Возвращает:
+        list: Список объектов chess.pgn.Game (или CompactGame)
+    """
+    if compact:
+        with open_pgn_dump(path) as stream:
+            return parse_compact_games(
+                list(iter_pgn_texts(line.rstrip("\n") for line in TextIOWrapper(stream, encoding="utf-8"))), processes=processes
+            )
+
+    games = []
+    with TextIOWrapper(open_pgn_dump(path), encoding="utf-8") as f:
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                break
+            games.append(game)
+    return games
+
+def add_normalized_metrics(data):
+    """Добавляет нормализованные метрики: корень из потерь сантипешек и квадрат точности"""
+    data['Normalized AvgLoss'] = data['AvgLoss'].apply(lambda x: x ** 0.5)
+    data['Normalized Accuracy'] = data['Accuracy'].apply(lambda x: x ** 2)
+    return data
+
+def load_stats(path, min_moves=None):
+    """
+    Загружает метрики партий из CSV (или индекс базы BaselineIndex из .json)
 
-detecting_cheaters_if_distributions_are_not_normal(players_stats, tournament_stats)
+    Параметры:
+        path (str): Путь к файлу
+        min_moves (int): Оставить только партии, в которых больше min_moves ходов
+    """
+    if path.endswith(".json"):
+        return BaselineIndex(path)
+    data = pd.read_csv(path)
+    if min_moves is not None:
+        data = data[data['TotalMoves'] > min_moves]
+    return add_normalized_metrics(data.copy())
+
+def _cli_fetch(args):
+    games = get_player_games(args.username, days=args.days, perf_type=args.perf_type, token=args.token, evals=True if args.evals else None) or []
+    with open(args.output, "w", encoding="utf-8") as f:
+        for game in games:
+            f.write(str(game) + "\n\n")
+    print(f"Сохранено партий: {len(games)} -> {args.output}")
+
+def _cli_analyze(args):
+    cache = EvalCache(args.cache) if args.cache else None
+    resolver = None
+    if args.book or args.syzygy or args.opening_index:
+        resolver = PositionResolver(book_path=args.book, syzygy_path=args.syzygy, opening_index=args.opening_index)
+    try:
+        if args.pgn:
+            games = read_pgn_file(args.pgn, compact=True, processes=args.processes)
+            if args.schedule:
+                all_games_scores, _ = analyze_games_scheduled(
+                    games, args.engine, depth=args.depth, n_engines=args.n_engines, threads=args.threads,
+                    hash_mb=args.hash, cache=cache
+                )
+            else:
+                all_games_scores = analyze_games_with_engine(
+                    games, args.engine, depth=args.depth, n_engines=args.n_engines, threads=args.threads,
+                    hash_mb=args.hash, cache=cache, use_pgn_evals=args.use_pgn_evals, resolver=resolver
+                )
+            metrics = calculate_metrics_vectorized(games, all_games_scores, args.username)
+        else:
+            metrics = analyze_player_performance(
+                args.username, args.engine, token=args.token, days=args.days, perf_type=args.perf_type, depth=args.depth,
+                n_engines=args.n_engines, threads=args.threads, hash_mb=args.hash, cache=cache, use_pgn_evals=args.use_pgn_evals,
+                resolver=resolver
+            )
+    finally:
+        if cache is not None:
+            cache.close()
+        if resolver is not None:
+            resolver.close()
+    metrics.to_csv(args.output, index=False)
+    print(f"Сохранены метрики партий: {len(metrics)} -> {args.output}")
+
+def _cli_submit(args):
+    work_queue = WorkQueue(args.queue)
+    try:
+        games = read_pgn_file(args.pgn, compact=True, processes=args.processes)
+        n_jobs = work_queue.submit(games, batch=args.batch, depth=args.depth, job_size=args.job_size)
+        print(f"Партий: {len(games)}, новых заданий: {n_jobs}; очередь: {work_queue.progress(args.batch)}")
+    finally:
+        work_queue.close()
+
+def _cli_worker(args):
+    cache = EvalCache(args.cache) if args.cache else None
+    work_queue = WorkQueue(args.queue, lease_seconds=args.lease)
+    try:
+        completed = run_worker(
+            work_queue, args.engine, n_engines=args.n_engines, threads=args.threads, hash_mb=args.hash,
+            cache=cache, exit_when_idle=not args.wait
+        )
+        print(f"Выполнено заданий: {completed}")
+    finally:
+        work_queue.close()
+        if cache is not None:
+            cache.close()
+
+def _cli_collect(args):
+    work_queue = WorkQueue(args.queue)
+    try:
+        print(f"Очередь: {work_queue.progress(args.batch)}")
+        games, all_games_scores = work_queue.results(args.batch)
+    finally:
+        work_queue.close()
+    metrics = calculate_metrics_vectorized(games, all_games_scores, args.username)
+    metrics.to_csv(args.output, index=False)
+    print(f"Сохранены метрики партий: {len(metrics)} -> {args.output}")
+
+def _cli_test(args):
+    baseline = load_stats(args.baseline, min_moves=1)
+    suspects = load_stats(args.suspects)
+    check_dispersion_equality(baseline, suspects)
+    if args.nonparametric:
+        detecting_cheaters_if_distributions_are_not_normal(baseline, suspects)
+    else:
+        detecting_cheaters(baseline, suspects)
 
+def _cli_sequential(args):
+    cache = EvalCache(args.cache) if args.cache else None
+    try:
+        if args.pgn:
+            games = read_pgn_file(args.pgn, compact=True, processes=args.processes)
+        else:
+            games = iter_player_games(args.username, days=args.days, perf_type=args.perf_type, token=args.token, compact=True)
+        result = detecting_cheaters_sequential(
+            games, args.username, load_stats(args.baseline, min_moves=1), args.engine, depth=args.depth,
+            batch_size=args.batch_size, max_games=args.max_games, alpha=args.alpha, beta=args.beta, effect=args.effect,
+            n_engines=args.n_engines, threads=args.threads, hash_mb=args.hash, cache=cache
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+    if args.output:
+        result["data"].to_csv(args.output, index=False)
+        print(f"Сохранены метрики партий: {len(result['data'])} -> {args.output}")
+
+def _cli_report(args):
+    import matplotlib
+    matplotlib.use("Agg")                              # Графики только в файлы, без GUI
+    os.makedirs(args.output_dir, exist_ok=True)
+    players_stats = pd.read_csv(args.baseline)
+    players_stats = players_stats[players_stats['TotalMoves'] > 1].copy()
+    tournament_stats = add_normalized_metrics(pd.read_csv(args.suspects))
+
+    print(players_stats.describe().apply(lambda x: round(x, 1)))
+    print(tournament_stats.describe().apply(lambda x: round(x, 1)))
+
+    plot_all_metrics(players_stats, path=os.path.join(args.output_dir, "metrics.png"))
+
+    normality_check(players_stats['AvgLoss'], path=os.path.join(args.output_dir, "normality_avgloss.png"))
+    normality_check(players_stats['Accuracy'], path=os.path.join(args.output_dir, "normality_accuracy.png"))
+    add_normalized_metrics(players_stats)
+    normality_check(players_stats['Normalized AvgLoss'], path=os.path.join(args.output_dir, "normality_normalized_avgloss.png"))
+    normality_check(players_stats['Normalized Accuracy'], path=os.path.join(args.output_dir, "normality_normalized_accuracy.png"))
+    normality_check(tournament_stats['Normalized AvgLoss'], path=os.path.join(args.output_dir, "normality_suspects_normalized_avgloss.png"))
+    normality_check(tournament_stats['Normalized Accuracy'], path=os.path.join(args.output_dir, "normality_suspects_normalized_accuracy.png"))
+
+    detecting_cheaters(players_stats, tournament_stats)
+    detecting_cheaters_if_distributions_are_not_normal(players_stats, tournament_stats)
+    print(f"Графики сохранены в {args.output_dir}")
+
+def build_parser():
+    """Парсер аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="Выявление читеров на Lichess")
+    commands = parser.add_subparsers(dest="command")
+
+    def add_lichess_args(command):
+        command.add_argument("--token", default=os.environ.get("LICHESS_TOKEN", "your_token"), help="Токен Lichess API (по умолчанию $LICHESS_TOKEN)")
+        command.add_argument("--days", type=int, default=365, help="За сколько дней выгружать партии")
+        command.add_argument("--perf-type", default="blitz", help="Тип игры: blitz, bullet, rapid, ...")
+
+    fetch = commands.add_parser("fetch", help="Выгрузить партии игрока в PGN-файл")
+    fetch.add_argument("username")
+    add_lichess_args(fetch)
+    fetch.add_argument("--evals", action="store_true", help="Запросить серверные оценки [%%eval ...]")
+    fetch.add_argument("-o", "--output", default="games.pgn")
+    fetch.set_defaults(handler=_cli_fetch)
+
+    analyze = commands.add_parser("analyze", help="Проанализировать партии движком и сохранить метрики в CSV")
+    analyze.add_argument("username")
+    add_lichess_args(analyze)
+    analyze.add_argument("--pgn", help="Взять партии из PGN-файла (.pgn, .pgn.bz2, .pgn.zst) вместо Lichess")
+    analyze.add_argument("--engine", default="/usr/games/stockfish", help="Путь к движку")
+    analyze.add_argument("--depth", type=int, default=20)
+    analyze.add_argument("--n-engines", type=int, default=1)
+    analyze.add_argument("--threads", type=int)
+    analyze.add_argument("--hash", type=int, help="Опция Hash (МБ) для каждого процесса движка")
+    analyze.add_argument("--cache", help="Файл кеша оценок позиций (SQLite)")
+    analyze.add_argument("--processes", type=int, help="Число процессов для разбора PGN-файла")
+    analyze.add_argument("--book", help="Книга дебютов Polyglot (.bin)")
+    analyze.add_argument("--syzygy", help="Каталог с таблицами Syzygy")
+    analyze.add_argument("--opening-index", help="Индекс дебютов корпуса (JSON, OpeningIndex)")
+    analyze.add_argument("--schedule", action="store_true", help="Искать каждую различную позицию PGN-файла один раз (только с --pgn, без --book/--syzygy/--opening-index/--use-pgn-evals)")
+    analyze.add_argument("--use-pgn-evals", action="store_true", help="Брать оценки [%%eval ...] из PGN, где они есть")
+    analyze.add_argument("-o", "--output", default="stats.csv")
+    analyze.set_defaults(handler=_cli_analyze)
+
+    submit = commands.add_parser("submit", help="Поставить партии PGN-файла в очередь заданий анализа")
+    submit.add_argument("queue", help="Файл очереди (SQLite)")
+    submit.add_argument("pgn", help="PGN-файл с партиями")
+    submit.add_argument("--batch", default="default", help="Имя пакета партий")
+    submit.add_argument("--depth", type=int, default=20)
+    submit.add_argument("--job-size", type=int, default=50, help="Число партий в задании")
+    submit.add_argument("--processes", type=int, help="Число процессов для разбора PGN-файла")
+    submit.set_defaults(handler=_cli_submit)
+
+    worker = commands.add_parser("worker", help="Обрабатывать задания из очереди (можно запускать на многих узлах)")
+    worker.add_argument("queue", help="Файл очереди (SQLite)")
+    worker.add_argument("--engine", default="/usr/games/stockfish", help="Путь к движку")
+    worker.add_argument("--n-engines", type=int, default=1)
+    worker.add_argument("--threads", type=int)
+    worker.add_argument("--hash", type=int, help="Опция Hash (МБ) для каждого процесса движка")
+    worker.add_argument("--cache", help="Файл кеша оценок позиций (SQLite)")
+    worker.add_argument("--lease", type=float, default=300, help="Срок аренды задания, с")
+    worker.add_argument("--wait", action="store_true", help="Не завершаться, когда очередь пуста")
+    worker.set_defaults(handler=_cli_worker)
+
+    collect = commands.add_parser("collect", help="Собрать метрики проанализированных партий пакета в CSV")
+    collect.add_argument("queue", help="Файл очереди (SQLite)")
+    collect.add_argument("username")
+    collect.add_argument("--batch", default="default", help="Имя пакета партий")
+    collect.add_argument("-o", "--output", default="stats.csv")
+    collect.set_defaults(handler=_cli_collect)
+
+    sequential = commands.add_parser("sequential", help="Последовательная проверка: анализ порциями до первого решения")
+    sequential.add_argument("username")
+    sequential.add_argument("baseline", help="CSV с метриками общей выборки или индекс BaselineIndex (.json)")
+    add_lichess_args(sequential)
+    sequential.add_argument("--pgn", help="Взять партии из PGN-файла (.pgn, .pgn.bz2, .pgn.zst) вместо Lichess")
+    sequential.add_argument("--engine", default="/usr/games/stockfish", help="Путь к движку")
+    sequential.add_argument("--depth", type=int, default=20)
+    sequential.add_argument("--n-engines", type=int, default=1)
+    sequential.add_argument("--threads", type=int)
+    sequential.add_argument("--hash", type=int, help="Опция Hash (МБ) для каждого процесса движка")
+    sequential.add_argument("--cache", help="Файл кеша оценок позиций (SQLite)")
+    sequential.add_argument("--processes", type=int, help="Число процессов для разбора PGN-файла")
+    sequential.add_argument("--batch-size", type=int, default=10, help="Число партий в порции между проверками")
+    sequential.add_argument("--max-games", type=int, help="Максимальное число анализируемых партий")
+    sequential.add_argument("--alpha", type=float, default=0.05, help="Вероятность ложного вердикта 'anomalous'")
+    sequential.add_argument("--beta", type=float, default=0.2, help="Вероятность пропустить сдвиг величиной --effect")
+    sequential.add_argument("--effect", type=float, default=0.5, help="Искомый сдвиг средних в стандартных отклонениях базы")
+    sequential.add_argument("-o", "--output", help="Сохранить метрики проанализированных партий в CSV")
+    sequential.set_defaults(handler=_cli_sequential)
+
+    test = commands.add_parser("test", help="Проверить гипотезу об аномальности партий")
+    test.add_argument("baseline", help="CSV с метриками общей выборки или индекс BaselineIndex (.json)")
+    test.add_argument("suspects", help="CSV с метриками исследуемых партий")
+    test.add_argument("--nonparametric", action="store_true", help="Непараметрические тесты (распределения не нормальны)")
+    test.set_defaults(handler=_cli_test)
+
+    report = commands.add_parser("report", help="Полный отчет: статистики, графики (в файлы) и тесты")
+    report.add_argument("baseline", nargs="?", default="players_stats.csv")
+    report.add_argument("suspects", nargs="?", default="tournament_stats.csv")
+    report.add_argument("--output-dir", default="report")
+    report.set_defaults(handler=_cli_report)
+    return parser
+
+def main(argv=None):
+    """
+    Точка входа командной строки. Без подкоманды строится отчет по players_stats.csv и tournament_stats.csv
+
+    Примеры:
+        python detecting_cheaters_on_lichess.py fetch USERNAME --token TOKEN
+        python detecting_cheaters_on_lichess.py analyze USERNAME --pgn games.pgn --engine /usr/games/stockfish
+        python detecting_cheaters_on_lichess.py test players_stats.csv tournament_stats.csv
+        python detecting_cheaters_on_lichess.py sequential USERNAME players_stats.csv --pgn games.pgn
+        python detecting_cheaters_on_lichess.py report --output-dir report
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["report"] + list(argv if argv is not None else sys.argv[1:]))
+    if args.command == "analyze" and args.schedule:
+        # analyze_games_scheduled ищет позиции без учета партии: книге и оценкам из PGN нужна история партии
+        if not args.pgn:
+            parser.error("analyze: --schedule работает только с --pgn")
+        ignored = [
+            option for option, value in (
+                ("--use-pgn-evals", args.use_pgn_evals), ("--book", args.book),
+                ("--syzygy", args.syzygy), ("--opening-index", args.opening_index)
+            ) if value
+        ]
+        if ignored:
+            parser.error(f"analyze: --schedule нельзя сочетать с {', '.join(ignored)}")
+    args.handler(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())